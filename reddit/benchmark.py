@@ -0,0 +1,53 @@
+"""
+Measures crawler throughput against mockserver.py, so changes to the crawler
+can be compared without spending real API quota.
+
+python3 reddit/benchmark.py --comments 2000 --latency 0.05
+"""
+
+import argparse, time
+
+import mockserver
+from reddit import Reddit, Submission, Throttler, create_submission
+import reddit as redditmodule
+
+def run(name, server, fn):
+  server.reset_stats()
+  start = time.time()
+  n = fn()
+  dt = time.time() - start
+  requests = sum(s['requests'] for s in server.stats.values())
+  kb = sum(s['bytes'] for s in server.stats.values()) / 1024
+  print('%-40s %8.2fs %8d requests %10.1f KB %8d items %10.1f items/s' % (name, dt, requests, kb, n, n / dt if dt > 0 else 0))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the crawler against a local mock reddit')
+  parser.add_argument('--posts', type=int, default=3, help='Posts per subreddit')
+  parser.add_argument('--comments', type=int, default=1000, help='Comments per post')
+  parser.add_argument('--max-depth', type=int, default=8, help='Maximum comment depth')
+  parser.add_argument('--latency', type=float, default=0.05, help='Seconds the server delays each response by')
+  parser.add_argument('--qps', type=float, default=1000.0, help='Client request rate')
+  parser.add_argument('--concurrency', '-c', type=int, default=8, help='Concurrency for the concurrent runs')
+  args = parser.parse_args()
+
+  redditmodule.VERBOSITY = 0
+
+  corpus = mockserver.SyntheticReddit(('TheMotte',), args.posts, args.comments, args.max_depth)
+  server = mockserver.start(corpus, latency=args.latency)
+  reddit = Reddit(secret=mockserver.kMockSecret, host=server.url, pool_size=max(10, args.concurrency))
+  reddit.throttler = Throttler(args.qps)
+
+  postid = corpus.posts['TheMotte'][0].id
+  print(f'{args.comments} comments per thread, {args.latency}s latency, {args.qps} qps')
+
+  run('new_submissions', server, lambda: len(reddit.new_submissions('TheMotte', limit=args.posts)))
+  run('Submission', server, lambda: len(Submission(reddit, postid, order='new').comments))
+  run(f'Submission (concurrency={args.concurrency})', server,
+    lambda: len(Submission(reddit, postid, order='new', concurrency=args.concurrency).comments))
+  run('create_submission (no early stop)', server,
+    lambda: len(create_submission(reddit, postid, early_stop=False).comments))
+  run('create_submission', server, lambda: len(create_submission(reddit, postid).comments))
+  run(f'create_submission (concurrency={args.concurrency})', server,
+    lambda: len(create_submission(reddit, postid, concurrency=args.concurrency).comments))
+
+  server.shutdown()
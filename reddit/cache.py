@@ -0,0 +1,96 @@
+"""
+An on-disk store of reddit API responses, keyed by URL.
+
+Modes:
+
+record: fresh entries (younger than 'ttl' seconds) are served from disk;
+        everything else is requested and the response is stored.  This way
+        re-running a crawl after a crash doesn't spend quota on responses we
+        just got.  Listings (/new, /comments, and a submission's
+        comments/<id>.json) change by the minute, so they only stay fresh
+        for 'listing_ttl' seconds (by default they're never served, only
+        stored for replay).
+
+replay: only serves what's on disk (regardless of age) and never touches the
+        network.  Misses behave like a failed request.  Useful for
+        deterministic, offline crawls (e.g. for benchmarking).
+"""
+
+import hashlib, json, os, time
+pjoin = os.path.join
+
+from metrics import endpoint
+
+kSecsPerHour = 60 * 60
+
+# Endpoint classes (see metrics.endpoint()) that get 'listing_ttl'.
+kListingEndpoints = ['listing', 'comments']
+
+class ResponseCache:
+  def __init__(self, path, mode='record', ttl=kSecsPerHour, listing_ttl=0.0):
+    assert mode in ['record', 'replay']
+    self.path = path
+    self.mode = mode
+    self.ttl = ttl
+    self.listingTtl = listing_ttl
+    os.makedirs(path, exist_ok=True)
+    if mode == 'record':
+      self.evict()
+
+  @property
+  def replay(self):
+    return self.mode == 'replay'
+
+  def _path(self, url):
+    h = hashlib.sha1(url.encode()).hexdigest()
+    return pjoin(self.path, h[:2], h + '.json')
+
+  # Returns the stored response for 'url', or None if there isn't a usable one.
+  def get(self, url):
+    path = self._path(url)
+    try:
+      with open(path, 'r') as f:
+        entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return None
+    if entry['url'] != url:
+      return None
+    ttl = self.listingTtl if endpoint(url) in kListingEndpoints else self.ttl
+    if not self.replay and time.time() - entry['time'] > ttl:
+      return None
+    return entry['response']
+
+  def put(self, url, response):
+    path = self._path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so concurrent readers (and crashes)
+    # never see a partial entry.
+    tmp = f'{path}.{os.getpid()}.{id(response)}.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({ 'url': url, 'time': time.time(), 'response': response }, f)
+    os.replace(tmp, path)
+
+  # Deletes entries older than the ttl.  Returns the number deleted.
+  def evict(self):
+    deleted = 0
+    now = time.time()
+    for d in os.listdir(self.path):
+      if not os.path.isdir(pjoin(self.path, d)):
+        continue
+      for fn in os.listdir(pjoin(self.path, d)):
+        path = pjoin(self.path, d, fn)
+        if now - os.path.getmtime(path) > self.ttl:
+          os.remove(path)
+          deleted += 1
+    return deleted
+
+def add_cache_args(parser):
+  parser.add_argument('--cache', type=str, required=False, default=None, help='Directory to cache API responses in')
+  parser.add_argument('--cache-mode', type=str, required=False, default='record', choices=['record', 'replay'], help='"record" fetches and stores misses; "replay" only serves from the cache')
+  parser.add_argument('--cache-ttl', type=float, required=False, default=kSecsPerHour, help='Seconds a cached response stays fresh in "record" mode')
+  parser.add_argument('--cache-listing-ttl', type=float, required=False, default=0.0, help='Seconds a cached listing (/new, /comments, comments/<id>.json) stays fresh in "record" mode')
+
+def cache_from_args(args):
+  if args.cache is None:
+    return None
+  return ResponseCache(args.cache, mode=args.cache_mode, ttl=args.cache_ttl, listing_ttl=args.cache_listing_ttl)
@@ -0,0 +1,140 @@
+"""
+A small sqlite table of every post in the corpus: id, year, creation time,
+when we last refreshed it, how many comments it has and where it's stored.
+
+Writers update it as they write posts, so choosing which posts to refresh
+is an indexed query instead of a scan of the whole corpus.  It replaces
+refresh.json (which import_refresh_json migrates).
+"""
+
+import json, os, sqlite3, threading, time
+pjoin = os.path.join
+
+from corpus import post_year
+
+kColumns = ['postid', 'year', 'created_utc', 'last_refreshed', 'num_comments', 'location']
+
+class PostCatalog:
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.c = self.conn.cursor()
+    self.c.execute("""CREATE TABLE IF NOT EXISTS posts (
+      postid TEXT PRIMARY KEY,
+      year INTEGER,
+      created_utc REAL,
+      last_refreshed REAL,
+      num_comments INTEGER,
+      location TEXT
+    )""")
+    self.c.execute('CREATE INDEX IF NOT EXISTS posts_refresh ON posts (last_refreshed, created_utc)')
+    self.c.execute('CREATE INDEX IF NOT EXISTS posts_created ON posts (created_utc)')
+    self.conn.commit()
+
+  def __len__(self):
+    with self.lock:
+      self.c.execute('SELECT COUNT(*) FROM posts')
+      return self.c.fetchone()[0]
+
+  def __contains__(self, postid):
+    with self.lock:
+      self.c.execute('SELECT 1 FROM posts WHERE postid = ?', (postid,))
+      return self.c.fetchone() is not None
+
+  # Records that 'post' was written to 'location'.  last_refreshed is kept.
+  def update(self, post, location=None, commit=True):
+    with self.lock:
+      self.c.execute("""INSERT INTO posts VALUES (?, ?, ?, 0.0, ?, ?)
+        ON CONFLICT (postid) DO UPDATE SET
+          year = excluded.year,
+          created_utc = excluded.created_utc,
+          num_comments = excluded.num_comments,
+          location = excluded.location""",
+        (post['id'], post_year(post), post['created_utc'], len(post.get('comments', [])), location)
+      )
+      if commit:
+        self.conn.commit()
+
+  def mark_refreshed(self, postid, t=None):
+    with self.lock:
+      self.c.execute('UPDATE posts SET last_refreshed = ? WHERE postid = ?', (time.time() if t is None else t, postid))
+      self.conn.commit()
+
+  def get(self, postid):
+    with self.lock:
+      self.c.execute(f'SELECT {", ".join(kColumns)} FROM posts WHERE postid = ?', (postid,))
+      row = self.c.fetchone()
+    if row is None:
+      return None
+    return dict(zip(kColumns, row))
+
+  # Posts between 'min_age' and 'max_age' seconds old (see scheduler.py).
+  # With 'refreshed_before_age', only posts that haven't been refreshed
+  # since they were that old.
+  def candidates(self, min_age=0.0, max_age=float('inf'), refreshed_before_age=None):
+    now = time.time()
+    query = f'SELECT {", ".join(kColumns)} FROM posts WHERE created_utc <= ?'
+    params = [now - min_age]
+    if max_age != float('inf'):
+      query += ' AND created_utc >= ?'
+      params.append(now - max_age)
+    if refreshed_before_age is not None:
+      query += ' AND last_refreshed < created_utc + ?'
+      params.append(refreshed_before_age)
+    with self.lock:
+      self.c.execute(query, params)
+      return [dict(zip(kColumns, row)) for row in self.c.fetchall()]
+
+  # Adds every post in 'corpus' we don't know about.  Only those posts are
+  # read, but the whole corpus is listed, so this is for building the catalog
+  # (or repairing it), not for every run.
+  def backfill(self, corpus):
+    with self.lock:
+      self.c.execute('SELECT postid FROM posts')
+      known = set(r[0] for r in self.c.fetchall())
+    n = 0
+    for year, postid in corpus.postids():
+      if postid in known:
+        continue
+      post = corpus.get(postid, year)
+      self.update(post, corpus.location(postid, year), commit=False)
+      n += 1
+    self.commit()
+    return n
+
+  # Copies last_refreshed times over from a refresh.json.
+  def import_refresh_json(self, path):
+    with open(path, 'r') as f:
+      refresh = json.load(f)
+    with self.lock:
+      for postid, a in refresh.items():
+        self.c.execute('UPDATE posts SET last_refreshed = ? WHERE postid = ?', (a['last_refreshed'], postid))
+      self.conn.commit()
+
+  def commit(self):
+    with self.lock:
+      self.conn.commit()
+
+# The first time we run with a catalog we fill it from the corpus (and
+# carry over refresh times from refresh.json, which it replaces).  After
+# that every writer updates it as it writes; 'backfill' adds whatever was
+# written without it (see --backfill-catalog).
+def open_catalog(corpus, outdir, path=None, backfill=False):
+  catalog = PostCatalog(pjoin(outdir, 'catalog.db') if path is None else path)
+  first = len(catalog) == 0
+  if first or backfill:
+    print(f'Added {catalog.backfill(corpus)} posts to the catalog')
+  if first and os.path.exists(pjoin(outdir, 'refresh.json')):
+    catalog.import_refresh_json(pjoin(outdir, 'refresh.json'))
+  return catalog
+
+def add_catalog_args(parser):
+  parser.add_argument('--catalog', type=str, required=False, default=None, help='Post catalog (defaults to catalog.db in outdir)')
+  parser.add_argument('--backfill-catalog', action='store_true', help='Add posts the catalog is missing (written without it) from the corpus')
+
+# The catalog of the corpus at 'outdir', if it has one, for writers that
+# only add to a corpus (we don't want to create one that open_catalog()
+# would then think is already filled).
+def existing_catalog(outdir, path=None):
+  path = pjoin(outdir, 'catalog.db') if path is None else path
+  return PostCatalog(path) if os.path.exists(path) else None
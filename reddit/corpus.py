@@ -0,0 +1,326 @@
+"""
+Storage for the thread corpus (each thread is a post's json with a
+"comments" list).  There are two layouts with the same interface:
+
+JsonDirectory: one json file per thread, <base>/<year>/<postid>.json
+
+SegmentStore: append-only segment files of zlib-compressed threads, plus an
+sqlite index from post id to (segment, offset, length), so a thread can be
+read without touching any other.  Writing a thread again appends the new
+version and repoints the index; the old bytes are dropped by compact().
+
+open_corpus(path) returns whichever one lives at 'path'.  To convert:
+
+python3 reddit/corpus.py pack reddit/c2 reddit/c2-packed
+python3 reddit/corpus.py unpack reddit/c2-packed reddit/c2
+"""
+
+import argparse, collections, json, os, shutil, sqlite3, threading, zlib
+from datetime import datetime
+pjoin = os.path.join
+
+kIndexName = 'index.db'
+
+# New segments are started once the current one is this big.
+kMaxSegmentSize = 256 * 1024 * 1024
+
+# Reads one thread given a segment file, offset and length.  This doesn't
+# need a SegmentStore, so worker processes can call it directly.
+def read_record(path, offset, length):
+  with open(path, 'rb') as f:
+    f.seek(offset)
+    return json.loads(zlib.decompress(f.read(length)))
+
+def post_year(post):
+  return datetime.utcfromtimestamp(post['created_utc']).year
+
+class JsonDirectory:
+  def __init__(self, base, indent=None):
+    self.base = base
+    self.indent = indent
+
+  def path(self, year, postid):
+    return pjoin(self.base, str(year), postid + '.json')
+
+  # Returns the thread, or None if we don't have it.  We look in 'year' and
+  # (since a post's year can be off by one) the year before.
+  def get(self, postid, year):
+    for y in [year, year - 1]:
+      path = self.path(y, postid)
+      if os.path.exists(path):
+        with open(path, 'r') as f:
+          return json.load(f)
+    return None
+
+  # Returns where the post was written (see location()).
+  def put(self, post):
+    path = self.path(post_year(post), post['id'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w+') as f:
+      json.dump(post, f, indent=self.indent)
+    return path
+
+  def location(self, postid, year):
+    for y in [year, year - 1]:
+      if os.path.exists(self.path(y, postid)):
+        return self.path(y, postid)
+    return None
+
+  # Returns a list of (year, postid) for every thread.
+  def postids(self, years=None):
+    R = []
+    if not os.path.exists(self.base):
+      return R
+    for year in sorted(os.listdir(self.base)):
+      if not year.isdigit() or not os.path.isdir(pjoin(self.base, year)):
+        continue
+      if years is not None and int(year) not in [int(y) for y in years]:
+        continue
+      for fn in os.listdir(pjoin(self.base, year)):
+        if fn[-5:] == '.json':
+          R.append((int(year), fn[:-5]))
+    return R
+
+  def threads(self, years=None):
+    for year, postid in self.postids(years):
+      with open(self.path(year, postid), 'r') as f:
+        yield json.load(f)
+
+  def commit(self):
+    pass
+
+class SegmentStore:
+  def __init__(self, path, max_segment_size=kMaxSegmentSize):
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self.maxSegmentSize = max_segment_size
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(pjoin(path, kIndexName), check_same_thread=False)
+    self.c = self.conn.cursor()
+    self.c.execute("""CREATE TABLE IF NOT EXISTS posts (
+      postid TEXT PRIMARY KEY,
+      year INTEGER,
+      segment INTEGER,
+      offset INTEGER,
+      length INTEGER
+    )""")
+    self.c.execute('CREATE INDEX IF NOT EXISTS posts_year ON posts (year)')
+    self.conn.commit()
+
+    segments = self._segments()
+    self.segment = segments[-1] if len(segments) > 0 else 0
+    self.writer = open(self._segment_path(self.segment), 'ab')
+    self.readers = {}
+
+  @staticmethod
+  def exists(path):
+    return os.path.exists(pjoin(path, kIndexName))
+
+  def _segment_path(self, segment):
+    return pjoin(self.path, 'seg-%05d.dat' % segment)
+
+  def _segments(self):
+    return sorted(int(fn[4:9]) for fn in os.listdir(self.path) if fn[:4] == 'seg-' and fn[-4:] == '.dat')
+
+  # The segments and the index (with any sqlite side files).
+  def _own_files(self):
+    names = ['seg-%05d.dat' % segment for segment in self._segments()]
+    names += [kIndexName + suffix for suffix in ['', '-journal', '-wal', '-shm']]
+    return [fn for fn in names if os.path.isfile(pjoin(self.path, fn))]
+
+  def _read(self, segment, offset, length):
+    if segment not in self.readers:
+      self.readers[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+    return json.loads(zlib.decompress(os.pread(self.readers[segment], length, offset)))
+
+  # Returns the thread, or None if we don't have it.  'year' is accepted for
+  # compatibility with JsonDirectory; the index doesn't need it.
+  def get(self, postid, year=None):
+    with self.lock:
+      self.c.execute('SELECT segment, offset, length FROM posts WHERE postid = ?', (postid,))
+      row = self.c.fetchone()
+      if row is None:
+        return None
+      return self._read(*row)
+
+  def __contains__(self, postid):
+    with self.lock:
+      self.c.execute('SELECT 1 FROM posts WHERE postid = ?', (postid,))
+      return self.c.fetchone() is not None
+
+  # Returns where the post was written (see location()).
+  #
+  # The data is flushed before the index is updated, so a crash can leave
+  # unreferenced bytes at the end of a segment but never a broken index.
+  def put(self, post, commit=True):
+    data = zlib.compress(json.dumps(post).encode())
+    with self.lock:
+      if self.writer.tell() > 0 and self.writer.tell() + len(data) > self.maxSegmentSize:
+        self.writer.close()
+        self.segment += 1
+        self.writer = open(self._segment_path(self.segment), 'ab')
+      offset = self.writer.tell()
+      self.writer.write(data)
+      self.writer.flush()
+      self.c.execute(
+        'INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)',
+        (post['id'], post_year(post), self.segment, offset, len(data))
+      )
+      if commit:
+        self.conn.commit()
+      return f'{self._segment_path(self.segment)}:{offset}'
+
+  # "<segment path>:<offset>", or None if we don't have the post.
+  def location(self, postid, year=None):
+    with self.lock:
+      self.c.execute('SELECT segment, offset FROM posts WHERE postid = ?', (postid,))
+      row = self.c.fetchone()
+    if row is None:
+      return None
+    return f'{self._segment_path(row[0])}:{row[1]}'
+
+  def commit(self):
+    with self.lock:
+      self.conn.commit()
+
+  # Returns a list of (year, postid) for every thread.
+  def postids(self, years=None):
+    with self.lock:
+      self.c.execute('SELECT year, postid FROM posts ORDER BY year, segment, offset')
+      rows = self.c.fetchall()
+    if years is not None:
+      years = set(int(y) for y in years)
+      rows = [r for r in rows if r[0] in years]
+    return rows
+
+  # Returns (year, segment, offset, length) for every thread, in segment
+  # order.
+  def _rows(self, years=None):
+    with self.lock:
+      self.c.execute('SELECT year, segment, offset, length FROM posts ORDER BY year, segment, offset')
+      rows = self.c.fetchall()
+    if years is not None:
+      years = set(int(y) for y in years)
+      rows = [r for r in rows if r[0] in years]
+    return rows
+
+  # Returns (segment path, offset, length) for every thread, in the same
+  # order as threads().
+  def locations(self, years=None):
+    return [(self._segment_path(segment), offset, length) for _, segment, offset, length in self._rows(years)]
+
+  # Threads are read in segment order, so this is (mostly) sequential I/O.
+  def threads(self, years=None):
+    for _, segment, offset, length in self._rows(years):
+      with self.lock:
+        post = self._read(segment, offset, length)
+      yield post
+
+  # Rewrites the store without the bytes of superseded threads.
+  def compact(self):
+    tmp = self.path.rstrip('/') + '.compact'
+    if os.path.exists(tmp):
+      shutil.rmtree(tmp)
+    other = SegmentStore(tmp, self.maxSegmentSize)
+    for post in self.threads():
+      other.put(post, commit=False)
+    other.commit()
+    other.close()
+    self.close()
+    # Only remove the files the store owns: the directory is usually shared
+    # with the catalog, the journal, etc.
+    for fn in self._own_files():
+      os.remove(pjoin(self.path, fn))
+    for fn in os.listdir(tmp):
+      os.replace(pjoin(tmp, fn), pjoin(self.path, fn))
+    os.rmdir(tmp)
+    self.__init__(self.path, self.maxSegmentSize)
+
+  def close(self):
+    self.writer.close()
+    for fd in self.readers.values():
+      os.close(fd)
+    self.readers = {}
+    self.conn.close()
+
+# Keeps the 'capacity' most recently used threads of 'corpus' in memory, so a
+# long-running process (see daemon.py) doesn't re-read hot threads from disk
+# every time it touches them.  Writes go straight through to the corpus.
+#
+# Callers tend to modify the threads they get, so we hand out copies.
+class ThreadCache:
+  def __init__(self, corpus, capacity=1000):
+    self.corpus = corpus
+    self.capacity = capacity
+    self.lock = threading.Lock()
+    self.threads = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  # Threads are kept serialized: callers modify what get() returns, and
+  # decoding a thread is several times faster than deep-copying it.
+  def _remember(self, post):
+    data = json.dumps(post).encode()
+    with self.lock:
+      self.threads[post['id']] = data
+      self.threads.move_to_end(post['id'])
+      while len(self.threads) > self.capacity:
+        self.threads.popitem(last=False)
+
+  def get(self, postid, year=None):
+    with self.lock:
+      data = self.threads.get(postid)
+      if data is not None:
+        self.hits += 1
+        self.threads.move_to_end(postid)
+      else:
+        self.misses += 1
+    if data is not None:
+      return json.loads(data)
+    post = self.corpus.get(postid, year)
+    if post is None:
+      return None
+    self._remember(post)
+    return post
+
+  def put(self, post, *args, **kwargs):
+    location = self.corpus.put(post, *args, **kwargs)
+    self._remember(post)
+    return location
+
+  def __getattr__(self, name):
+    # Everything else (location, postids, threads, commit, ...) is the
+    # corpus's.
+    return getattr(self.corpus, name)
+
+def open_corpus(path, indent=None):
+  if SegmentStore.exists(path):
+    return SegmentStore(path)
+  return JsonDirectory(path, indent=indent)
+
+def copy_corpus(src, dst):
+  n = 0
+  for post in src.threads():
+    if isinstance(dst, SegmentStore):
+      dst.put(post, commit=False)
+    else:
+      dst.put(post)
+    n += 1
+  dst.commit()
+  return n
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert the corpus between one-file-per-thread and segment files')
+  parser.add_argument('command', choices=['pack', 'unpack', 'compact'], help='"pack" a directory into a segment store, "unpack" a store into a directory, or "compact" a store')
+  parser.add_argument('src', type=str, help='Source corpus')
+  parser.add_argument('dst', type=str, nargs='?', default=None, help='Destination corpus')
+  args = parser.parse_args()
+
+  if args.command == 'compact':
+    SegmentStore(args.src).compact()
+  elif args.command == 'pack':
+    n = copy_corpus(JsonDirectory(args.src), SegmentStore(args.dst))
+    print(f'packed {n} threads')
+  else:
+    n = copy_corpus(SegmentStore(args.src), JsonDirectory(args.dst, indent=1))
+    print(f'unpacked {n} threads')
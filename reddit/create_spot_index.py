@@ -1,104 +1,208 @@
+"""
+Builds the spot index from the thread corpus.
+
+Reading threads, parsing their HTML and computing tokens is done by a pool
+of worker processes (see parallel_documents()); this process only inserts
+the documents, committing every --batch-size of them.
+
+The index is built as a new version next to the one being searched, which
+is only swapped in once the build is done (see indexversions.py), so search
+keeps working during a rebuild.  Changes journaled while we build (see
+update_spot_index.py) are replayed into the new version, from where the
+journal ended when we started, before it's published.  cronjob.py writes
+to the index directly rather than through the journal, so the documents it
+writes during the build are logged (see log_writes()) and copied over from
+the current version instead.
+
+Every build writes a manifest (<version>.manifest.json) with each thread's
+signature (see _thread_tasks() in utils.py) and the documents it produced.
+With --incremental the current version is copied and only threads whose
+signature changed are re-indexed: their documents are replaced, and
+documents of comments (or threads) that disappeared are deleted.
+
+python3 reddit/create_spot_index.py --processes 8
+python3 reddit/create_spot_index.py --incremental
+"""
+
 from utils import *
 
 import spot
 
 import time
 
-if os.path.exists('reddit/spot-index'):
-  os.remove('reddit/spot-index')
-
-index = spot.Index.create('reddit/spot-index', rankings=['score', 'created_utc'], ranges=['created_utc', 'score', 'depth', 'random'])
-
-comment_insertions = 0
-token_insertions = 0
-
-lasttime = time.time()
-
-ids = set()
-allscores = []
-threadCounter = 0
-for thread in threads(years=['2020', '2021']):
-  threadCounter += 1
-  assert thread['subreddit'] in ['TheMotte', 'slatestarcodex', 'theschism']
-  if thread['subreddit'] != 'theschism':
-    continue
-# for thread in threads():
-  comments = thread['comments']
-
-  print(threadCounter)
-
-  id2comment = {}
-  for comment in comments:
-    id2comment[comment['id']] = comment
-
-  for comment in comments:
-    if 'body_html' not in comment:
-      continue
-    if comment.get('body', '') == '[deleted]':
-      continue
-    if comment['body_html'] == '<div class="md"><p>[deleted]</p>\n</div>':
-      continue
-
-    # Threads have depth = 0
-    # All comments have depth > 0
-    depth = 1
-    parent = id2comment.get(comment['parent_id'][3:], None)
-    if parent:
-      depth += 1
-      ancestor = id2comment.get(parent['parent_id'][3:], None)
-      while ancestor and (ancestor['parent_id'][3:] in id2comment):
-        depth += 1
-        ancestor = id2comment.get(ancestor['parent_id'][3:], None)
-
-    comment['depth'] = depth
-
-    tokens = get_tokens(comment, parent, thread, isthread=False)
-    comment['tokens'] = ' '.join(tokens)
-
-    postid = permalink2postid(comment['permalink'])
-
-    # Save some space -- all this information is in body_html anyway
-    if 'body' in comment:
-      del comment['body']
-
-    if 'score' not in comment:
-      comment['score'] = comment.get('ups', 0)
-
-    id_ = int(comment['id'], 36)
-    if id_ in ids:
+from corpus import open_corpus
+from indexversions import current_version, finish_write_log, kKeepVersions, lock_index, new_version, publish, start_write_log
+from journal import ChangeJournal
+from update_spot_index import apply_journal, delete_document
+
+kSubreddits = ['theschism']
+
+def read_manifest(path):
+  if not os.path.exists(path):
+    return None
+  with open(path, 'r') as f:
+    return json.load(f)
+
+# Copies the documents 'docids' from the index at 'src' into 'index',
+# deleting those 'src' no longer has.  Returns the number copied.
+def copy_documents(src, index, docids):
+  if not os.path.exists(src):
+    return 0
+  conn = sqlite3.connect(src)
+  n = 0
+  for docid in docids:
+    row = conn.execute('SELECT postid, created_utc, json FROM documents WHERE docid = ?', (docid,)).fetchone()
+    if row is None:
+      delete_document(index, docid)
       continue
-    ids.add(id_)
-
-    comment['random'] = random.random()
-    comment['docid'] = id_
-    comment['postid'] = postid
-    comment['tokens'] = list(tokens)
-    index.insert(comment)
-    comment_insertions += 1
-    token_insertions += len(tokens)
-
-    if comment_insertions % 10000 == 0:
-    	print('%.3f' % (time.time() - lasttime), comment_insertions, token_insertions)
-    	lasttime = time.time()
-
-  continue
-  del thread['comments']
-  postid = int(thread['id'], 36)
-  tokens = get_tokens(thread, parent, thread, isthread=True)
-  thread['depth'] = 0
-  thread['tokens'] = ' '.join(tokens)
-  thread['random'] = random.random()
-  thread['score'] = thread.get('ups', 0)
-  # There's some bug that sometimes duplicates a thread across two different
-  # year directories (afaict this is only for threads between 2019 and 2020).
-  # Since 'threads' runs chronologically (oldest to newest) we simply replace
-  # the thread from 2019 (which is empirically always less up-to-date) with the
-  # thread from 2020.
-  # index.replace(postid, postid, thread['created_utc'], tokens, thread)
-
-index.create_indices()
-
-index.commit()
-
-print(comment_insertions, 'comments inserted')
-print(token_insertions, 'tokens inserted')
+    postid, created_utc, j = row
+    doc = json.loads(j)
+    # cronjob.py keeps its tokens as one space-separated string.
+    tokens = doc['tokens'].split(' ') if isinstance(doc['tokens'], str) else doc['tokens']
+    index.replace(docid, postid, created_utc, tokens, doc)
+    n += 1
+  conn.close()
+  return n
+
+def write_manifest(path, manifest):
+  with open(path + '.tmp', 'w') as f:
+    json.dump(manifest, f)
+  os.replace(path + '.tmp', path)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Build the spot index from the thread corpus')
+  parser.add_argument('--corpus', '-c', type=str, required=False, default='reddit/c2', help='Corpus to index')
+  parser.add_argument('--indexpath', '-ip', type=str, required=False, default='reddit/spot-index', help='Location of spot index')
+  parser.add_argument('--processes', '-p', type=int, required=False, default=None, help='Worker processes (defaults to one per core)')
+  parser.add_argument('--batch-size', type=int, required=False, default=10000, help='Documents per commit')
+  parser.add_argument('--incremental', action='store_true', help='Only re-index threads that changed since the last build')
+  parser.add_argument('--keep', type=int, required=False, default=kKeepVersions, help='Index versions to keep')
+  parser.add_argument('--journal', '-j', type=str, required=False, default=None, help='Change journal to catch up from (defaults to journal.jsonl in the corpus)')
+  args = parser.parse_args()
+
+  # Anything journaled from here on may have been missed by the copy or the
+  # scan, so it's replayed before publishing.
+  journal = ChangeJournal(pjoin(args.corpus, 'journal.jsonl') if args.journal is None else args.journal)
+  with lock_index(args.indexpath, exclusive=True):
+    startOffset = journal.end()
+    start_write_log(args.indexpath)
+
+  current = current_version(args.indexpath)
+  manifest = read_manifest(current + '.manifest.json') if args.incremental else None
+  if args.incremental and (manifest is None or not os.path.exists(current)):
+    print('No previous build; building from scratch')
+    manifest = None
+
+  version = new_version(args.indexpath)
+  print(f'Building {version}')
+  if manifest is None:
+    index = spot.Index.create(version, rankings=['score', 'created_utc'], ranges=['created_utc', 'score', 'depth', 'random'])
+    manifest = {}
+    incremental = False
+  else:
+    # The current version may be written to while we copy it.
+    src = sqlite3.connect(current)
+    dst = sqlite3.connect(version)
+    src.backup(dst)
+    dst.close()
+    src.close()
+    index = spot.Index(version)
+    incremental = True
+
+  comment_insertions = 0
+  token_insertions = 0
+  comment_deletions = 0
+
+  # Per-stage totals for the progress reports.  'prepareSeconds' is summed
+  # over all workers.
+  threadCounter = 0
+  prepareSeconds = 0.0
+  writeSeconds = 0.0
+  startTime = time.time()
+  lastReport = 0
+
+  def report():
+    elapsed = time.time() - startTime
+    print('%.1fs %d threads %d comments %d tokens %d deleted | prepare %.0f docs/s/worker | write %.0f docs/s | total %.0f docs/s' % (
+      elapsed, threadCounter, comment_insertions, token_insertions, comment_deletions,
+      comment_insertions / max(prepareSeconds, 1e-9),
+      comment_insertions / max(writeSeconds, 1e-9),
+      comment_insertions / max(elapsed, 1e-9),
+    ))
+
+  # Every thread still in the corpus, so we can tell which ones were removed.
+  present = set()
+  def skip(postid, sig):
+    present.add(postid)
+    return postid in manifest and manifest[postid]['sig'] == sig
+
+  ids = set()
+  for threads, seconds in parallel_documents(years=['2020', '2021'], base=args.corpus, subreddits=kSubreddits, processes=args.processes, skip=skip if incremental else None):
+    prepareSeconds += seconds
+
+    writeStart = time.time()
+    for postid, sig, docs in threads:
+      threadCounter += 1
+      docids = set()
+      for comment in docs:
+        id_ = comment['docid']
+        if id_ in ids:
+          continue
+        ids.add(id_)
+        docids.add(id_)
+
+        if incremental:
+          index.replace(id_, comment['postid'], comment['created_utc'], comment['tokens'], comment)
+        else:
+          index.insert(comment)
+        comment_insertions += 1
+        token_insertions += len(comment['tokens'])
+
+        if comment_insertions % args.batch_size == 0:
+          index.commit()
+
+      if postid in manifest:
+        for docid in set(manifest[postid]['docids']).difference(docids):
+          comment_deletions += delete_document(index, docid)
+      manifest[postid] = {'sig': sig, 'docids': sorted(docids)}
+    writeSeconds += time.time() - writeStart
+
+    if comment_insertions - lastReport >= args.batch_size:
+      report()
+      lastReport = comment_insertions
+
+  writeStart = time.time()
+  if incremental:
+    for postid in [postid for postid in manifest if postid not in present]:
+      for docid in manifest.pop(postid)['docids']:
+        comment_deletions += delete_document(index, docid)
+  else:
+    index.create_indices()
+  index.commit()
+  writeSeconds += time.time() - writeStart
+  report()
+
+  # Writers wait while we catch up and publish, so nothing lands in the old
+  # version after we've replayed the journal.
+  with lock_index(args.indexpath, exclusive=True):
+    entries, replaced, removed, endOffset = apply_journal(index, open_corpus(args.corpus), journal, startOffset)
+    print(f'Replayed {entries} journal entries ({replaced} documents replaced, {removed} deleted)')
+    copied = copy_documents(current_version(args.indexpath), index, finish_write_log(args.indexpath))
+    print(f'Copied {copied} documents written to the current version during the build')
+    index.commit()
+    # The manifest doesn't list documents the replay added, so the next
+    # incremental build re-indexes those threads.
+    for entry, offset in journal.read(startOffset):
+      if offset > endOffset:
+        break
+      if entry['postid'] in manifest:
+        manifest[entry['postid']]['sig'] = None
+
+    # Only once the index is committed does the manifest describe it.
+    write_manifest(version + '.manifest.json', manifest)
+    publish(args.indexpath, version, args.keep)
+  print(f'Published {version}')
+
+  print(comment_insertions, 'comments inserted')
+  print(token_insertions, 'tokens inserted')
+  print(comment_deletions, 'comments deleted')
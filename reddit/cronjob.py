@@ -4,16 +4,19 @@ cache.db contains all comments made in the past 2 weeks.
 
 This script runs once every 10 minutes (600 seconds).
 
-All 3 subreddits together (very roughly) generate 1 comment every minute. In the
-worst case we perform 3 queries per comment (t=0, t=2d, t=14d) which means we'll
-average 3 queries every minute (plus 3 every 10 minutes to find new comments).
+All 3 subreddits together (very roughly) generate 1 comment every minute. We
+fetch new comments with 3 queries every 10 minutes, and spend a fixed budget of
+queries (--refresh-budget) on refreshes.
 
 1) Fetches the 100 newest comments from each subreddit and
    inserts them into cache.db
 
-2) Finds all comments 2 or 14 days old and update them
+2) Refreshes the posts most likely to have changed (see scheduler.py)
 
 3) Finds all comments over 2 weeks old and removes them
+
+daemon.py can run steps 1 and 2 (--comments-interval, --reindex-interval)
+and the dump (--dump-interval) in one long-running process instead.
 """
 
 
@@ -27,12 +30,15 @@ tokens:
 
 """
 
-import argparse, code, json, os, random, requests, sqlite3, time
+import argparse, code, hashlib, itertools, json, os, random, requests, sqlite3, time
 from datetime import datetime
 
+from catalog import existing_catalog
 from reddit import Reddit, create_submission
+from scheduler import add_policy_args, kDefaultArchiveBudget, kDefaultBudget, OncePolicy, policy_from_args, RefreshPolicy, schedule_with_archive
 
 import spot
+from indexversions import current_version, lock_index, log_writes
 from utils import *
 
 # Script runs every 10 minutes, but we set this value to
@@ -41,36 +47,86 @@ kCronjobTimestep = 20 * 60
 
 kSecsPerDay = 60 * 60 * 24
 
+# The index holds every post we've ever seen, so the final two-week refresh
+# only looks at posts that turned two weeks old in the last few runs (like
+# the 20 minute window we used to refresh at 14 days).
+kArchivePolicy = OncePolicy(min_age=kSecsPerDay * 14, max_age=kSecsPerDay * 14 + 6 * kCronjobTimestep)
+
 def is_thread(comment):
   return 'title' in comment
 
+# Comments (and threads) from the index, keyed by docid, so working out a
+# comment's depth, parent and thread doesn't cost one query per ancestor.
+# prefetch() loads everything a batch of comments needs with a few bulk
+# queries.  Missing documents are cached as None.
+class AncestryCache:
+  kBatchSize = 500
+
+  def __init__(self, index):
+    self.index = index
+    self.docs = {}
+
+  def _load(self, docids):
+    docids = [docid for docid in set(docids) if docid not in self.docs]
+    for i in range(0, len(docids), self.kBatchSize):
+      batch = docids[i:i + self.kBatchSize]
+      for docid in batch:
+        self.docs[docid] = None
+      self.index.c.execute(f'SELECT docid, json FROM documents WHERE docid IN ({",".join("?" * len(batch))})', batch)
+      for docid, j in self.index.c.fetchall():
+        self.docs[docid] = json.loads(j)
+
+  def get(self, docid):
+    if docid not in self.docs:
+      self._load([docid])
+    return self.docs[docid]
+
+  # Records a comment we just inserted (so later comments can use it as a
+  # parent).
+  def remember(self, comment):
+    self.docs[int(comment['id'], 36)] = comment
+
+  # Loads the parents and threads of 'comments', and keeps loading parents
+  # until every chain reaches a thread or a missing document.
+  def prefetch(self, comments):
+    frontier = list(comments)
+    self._load(int(c['permalink'].split('/')[4], 36) for c in comments)
+    while len(frontier) > 0:
+      parents = [int(c['parent_id'][3:], 36) for c in frontier if not is_thread(c)]
+      self._load(parents)
+      frontier = [self.docs[p] for p in set(parents)]
+      frontier = [c for c in frontier if c is not None]
+
+  # Counts the ancestors up to the thread.  Depths stored in the index
+  # aren't used: indices built before ThreadTree (see utils.py) have them off
+  # by one from the third level down.
+  def depth(self, comment):
+    depth = 0
+    while not is_thread(comment):
+      comment = self.get(int(comment['parent_id'][3:], 36))
+      depth += 1
+      if comment is None:
+        break
+    return depth
+
 def compute_depth(index, comment):
-  depth = 0
-  while not is_thread(comment):
-    try:
-      comment = index.json_from_docid(int(comment['parent_id'][3:], 36))
-    except:
-      code.interact(local=locals())
-    depth += 1
-    if comment is None:
-      break
-  return depth
-
-def prep_comment_for_insertion(index, comment):
-  docid = int(comment['id'], 36)
-  oldcomment = index.json_from_docid(docid)
+  return AncestryCache(index).depth(comment)
+
+def prep_comment_for_insertion(index, comment, ancestry=None):
+  if ancestry is None:
+    ancestry = AncestryCache(index)
 
   if 'parent_id' in comment:
-    parent = index.json_from_docid(int(comment['parent_id'][3:], 36))
+    parent = ancestry.get(int(comment['parent_id'][3:], 36))
   else:
     parent = None
 
   thread_id = comment['permalink'].split('/')[4]
-  thread = index.json_from_docid(int(thread_id, 36))
+  thread = ancestry.get(int(thread_id, 36))
 
   comment['random'] = random.random()
 
-  comment['depth'] = compute_depth(index, comment)
+  comment['depth'] = ancestry.depth(comment)
   if is_thread(comment):
     assert comment['depth'] == 0
   else:
@@ -81,6 +137,280 @@ def prep_comment_for_insertion(index, comment):
 
   return comment
 
+# The filter tokens ThreadTree.tokens() (see utils.py) gives a comment.
+kTreeTokenPrefixes = ('replies:', 'subtree:')
+
+# Replaces the tree tokens in 'doc' with 'treeTokens'.  'tokens' is a list
+# in documents from create_spot_index.py and a string in ours.  Returns
+# whether they changed.
+def set_tree_tokens(doc, treeTokens):
+  isString = isinstance(doc['tokens'], str)
+  tokens = doc['tokens'].split(' ') if isString else doc['tokens']
+  new = [t for t in tokens if not t.startswith(kTreeTokenPrefixes)] + treeTokens
+  doc['tokens'] = ' '.join(new) if isString else new
+  return set(new) != set(tokens)
+
+# Gives 'docs' (comments from prep_comment_for_insertion()) the replies: and
+# subtree: tokens create_spot_index.py gives every comment, counting the
+# comments of their threads already in the index.  New comments change
+# their ancestors' counts too, so returns (postid, doc) for every ancestor
+# in the index whose tokens changed; those need writing as well.
+def add_tree_tokens(index, docs, batch_size=500):
+  new = {}
+  for doc in docs:
+    if not is_thread(doc):
+      new.setdefault(int(doc['permalink'].split('/')[4], 36), {})[doc['id']] = doc
+
+  stored = {}
+  postids = sorted(new)
+  for i in range(0, len(postids), batch_size):
+    batch = postids[i:i + batch_size]
+    index.c.execute(f'SELECT postid, json FROM documents WHERE postid IN ({",".join("?" * len(batch))})', batch)
+    for postid, j in index.c.fetchall():
+      doc = json.loads(j)
+      if not is_thread(doc) and 'parent_id' in doc:
+        stored.setdefault(postid, {})[doc['id']] = doc
+
+  changed = []
+  for postid, comments in new.items():
+    merged = stored.get(postid, {})
+    merged.update(comments)
+    tree = ThreadTree({'comments': list(merged.values())})
+    ancestors = set()
+    for cid, doc in comments.items():
+      set_tree_tokens(doc, tree.tokens(cid))
+      pid = tree.parent[cid]
+      while pid is not None and pid not in ancestors:
+        if pid not in comments:
+          ancestors.add(pid)
+        pid = tree.parent[pid]
+    for cid in ancestors:
+      if set_tree_tokens(merged[cid], tree.tokens(cid)):
+        changed.append((postid, merged[cid]))
+  return changed
+
+# Step 1: fetch the 'num' newest comments from 'subreddit' and insert them
+# into the index.  Returns the docids written (see log_writes()).
+def fetch_comments(index, reddit, subreddit, num):
+  r = reddit.request(
+    f"https://www.reddit.com/r/{subreddit}/comments.json?limit={num}")
+  assert r['kind'] == 'Listing'
+  comments = r['data']['children']
+
+  oldest_time = min(c['data']['created_utc'] for c in comments)
+
+  print(f'Fetched {subreddit} comments back to %.2f hours ago' % ((time.time() - oldest_time) / 3600))
+
+  ancestry = AncestryCache(index)
+  ancestry.prefetch([c['data'] for c in comments if c['kind'] == 't1'])
+
+  # Iterate through comments from old to new so parents are guaranteed to be
+  # prepared first.
+  docs = []
+  for comment in comments[::-1]:
+    if comment['kind'] != 't1':
+      print(f'WARNING: Unrecognized comment kind "{comment["kind"]}"')
+    comment = comment['data']
+
+    parts = comment['permalink'].split('/')
+    assert parts[0] == ''
+    assert parts[1] == 'r'
+    assert parts[2] == subreddit
+    assert parts[3] == 'comments'
+    post_id = int(parts[4], 36)
+    comment_id = parts[6]
+
+    comment = prep_comment_for_insertion(index, comment, ancestry)
+    ancestry.remember(comment)
+    docs.append((post_id, comment))
+
+  docs += add_tree_tokens(index, [comment for _, comment in docs])
+  return write_documents(index, docs)
+
+# Writes (postid, doc) pairs.  We use 'replace' here so when we insert a
+# comment twice (which is expected) we don't throw an error.  Returns the
+# docids written.
+def write_documents(index, docs):
+  written = []
+  for postid, doc in docs:
+    docid = int(doc['id'], 36)
+    tokens = doc['tokens'].split(' ') if isinstance(doc['tokens'], str) else doc['tokens']
+    index.replace(docid, postid, doc['created_utc'], tokens, doc)
+    written.append(docid)
+  return written
+
+# fetch_comments() used to store post ids as base36 strings, while every
+# other writer stores integers.  Converts the old rows, once per index (a
+# row in 'migrations' records that it's been done).  Returns the number of
+# posts converted.
+def migrate_postids(index):
+  index.c.execute('CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY)')
+  index.c.execute("SELECT 1 FROM migrations WHERE name = 'postids'")
+  if index.c.fetchone() is not None:
+    return 0
+  index.c.execute("SELECT DISTINCT postid FROM documents WHERE typeof(postid) = 'text'")
+  postids = [r[0] for r in index.c.fetchall()]
+  for postid in postids:
+    index.c.execute('UPDATE documents SET postid = ? WHERE postid = ?', (int(postid, 36), postid))
+  index.c.execute("INSERT INTO migrations VALUES ('postids')")
+  return len(postids)
+
+# When we last refreshed each post, in a table of its own next to the
+# documents.  Has the same candidates() and mark_refreshed() as
+# PostCatalog, so the scheduler (see scheduler.py) can use either.
+class IndexRefreshes:
+  def __init__(self, index):
+    self.index = index
+    self.index.c.execute('CREATE TABLE IF NOT EXISTS refreshed (postid INTEGER PRIMARY KEY, last_refreshed REAL)')
+
+  # A post's creation time is approximated by its oldest document (which is
+  # the post itself if we have it) and its number of comments by its number
+  # of documents.
+  #
+  # Only posts with a document created between 'max_age' and 'min_age' ago
+  # are grouped, so a narrow window doesn't scan the whole index.
+  def candidates(self, min_age=0.0, max_age=float('inf'), refreshed_before_age=None):
+    now = time.time()
+    self.index.c.execute("""SELECT d.postid, MIN(d.created_utc), COUNT(*), COALESCE(MAX(r.last_refreshed), 0.0)
+      FROM documents d LEFT JOIN refreshed r ON r.postid = d.postid
+      WHERE d.postid IN (SELECT DISTINCT postid FROM documents WHERE created_utc >= ? AND created_utc <= ?)
+      GROUP BY d.postid""", (0.0 if max_age == float('inf') else now - max_age, now - min_age))
+    R = []
+    for postid, created_utc, n, last_refreshed in self.index.c.fetchall():
+      if now - created_utc < min_age or now - created_utc > max_age:
+        continue
+      if refreshed_before_age is not None and last_refreshed >= created_utc + refreshed_before_age:
+        continue
+      R.append({'postid': postid, 'created_utc': created_utc, 'last_refreshed': last_refreshed, 'num_comments': n})
+    return R
+
+  def mark_refreshed(self, postid, t=None):
+    self.index.c.execute('INSERT OR REPLACE INTO refreshed VALUES (?, ?)', (postid, time.time() if t is None else t))
+
+# Yields every comment in a comment listing, parents before children.
+def walk_comments(children):
+  for child in children:
+    if child['kind'] != 't1':
+      continue
+    comment = child['data']
+    replies = comment.pop('replies', None)
+    yield comment
+    if isinstance(replies, dict):
+      yield from walk_comments(replies['data']['children'])
+
+# Step 2: refresh the posts most worth refreshing (see scheduler.py),
+# spending at most 'budget' requests, 'archive_budget' of them on posts due
+# their final refresh after two weeks.
+#
+# Refreshing a post is exactly one request, for comments/<id>.json with
+# limit=500.  "More comments" stubs are not expanded, so only the post and
+# the (up to) 500 comments in that response are updated; anything below a
+# stub keeps whatever we last got from fetch_comments().
+#
+# Returns the docids written (see log_writes()).
+def refresh_comments(index, reddit, budget=kDefaultBudget, policy=None, archive_budget=kDefaultArchiveBudget):
+  if policy is None:
+    policy = RefreshPolicy()
+  refreshes = IndexRefreshes(index)
+  posts = schedule_with_archive(refreshes, budget, policy, archive_budget, cost=lambda post: 1, archive=kArchivePolicy)
+  print(f'refreshing {len(posts)} posts')
+
+  written = []
+  for post in posts:
+    postid = post['postid']
+    print('refresh', base36(postid))
+    r = reddit.request(f"https://www.reddit.com/comments/{base36(postid)}.json?limit=500")
+    if r is None:
+      continue
+    comments = [c['data'] for c in r[0]['data']['children'] if c['kind'] == 't3']
+    comments += list(walk_comments(r[1]['data']['children']))
+
+    ancestry = AncestryCache(index)
+    ancestry.prefetch(comments)
+    docs = []
+    for comment in comments:
+      if comment['author'] == '[deleted]':
+        continue
+      comment = prep_comment_for_insertion(index, comment, ancestry)
+      ancestry.remember(comment)
+      docs.append((postid, comment))
+    docs += add_tree_tokens(index, [comment for _, comment in docs])
+    written += write_documents(index, docs)
+    refreshes.mark_refreshed(postid)
+  return written
+
+kDumpWindows = [0, 0.5, 1, 1.5, 2, 3, 4, 6, 8, 12, 16, 24]
+
+# Hashes of the threads we last dumped, so unchanged threads aren't
+# rewritten.  Maps post id to [hash, created_utc]; threads older than every
+# window are dropped.
+kDumpHashesName = 'dump-hashes.json'
+
+# Returns the ids of the threads created in any of the dump windows.  A
+# thread is the document whose docid is its own postid.
+def threads_to_dump(index):
+  now = time.time()
+  windows = [(now - kSecsPerDay * days - kCronjobTimestep, now - kSecsPerDay * days) for days in kDumpWindows]
+  where = ' OR '.join(['(created_utc > ? AND created_utc < ?)'] * len(windows))
+  index.c.execute(f'SELECT DISTINCT postid FROM documents WHERE docid = postid AND ({where})', [t for w in windows for t in w])
+  return sorted(r[0] for r in index.c.fetchall())
+
+# Yields every thread in 'postids' (a post's json with its "comments"),
+# reading all of them with one postid-ordered scan per batch.  Rows are
+# streamed off the cursor, so don't use index.c until this is done.
+def read_threads(index, postids, batch_size=500):
+  for i in range(0, len(postids), batch_size):
+    batch = postids[i:i + batch_size]
+    index.c.execute(f'SELECT postid, docid, json FROM documents WHERE postid IN ({",".join("?" * len(batch))}) ORDER BY postid, docid', batch)
+    for postid, rows in itertools.groupby(index.c, key=lambda row: row[0]):
+      post, comments = None, []
+      for _, docid, j in rows:
+        if docid == postid:
+          post = json.loads(j)
+        else:
+          comments.append(json.loads(j))
+      if post is None:
+        print(f'WARNING: no post for thread {postid}')
+        continue
+      post['comments'] = comments
+      yield post
+
+# Dump threads into comments.  This doesn't use network so we can do this
+# frequently.  Threads written are recorded in 'catalog' (a PostCatalog), if
+# given.  Returns the number of threads written.
+def dump_threads(index, outdir, catalog=None):
+  hashesPath = pjoin(outdir, kDumpHashesName)
+  hashes = {}
+  if os.path.exists(hashesPath):
+    with open(hashesPath, 'r') as f:
+      hashes = json.load(f)
+
+  written = 0
+  for post in read_threads(index, threads_to_dump(index)):
+    data = json.dumps(post, indent=1)
+    h = hashlib.sha1(data.encode()).hexdigest()
+    date = datetime.fromtimestamp(post['created_utc'])
+    fn = pjoin(outdir, str(date.year), post['id'] + '.json')
+    if hashes.get(post['id'], [None])[0] == h and os.path.exists(fn):
+      continue
+    print('dump', fn)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, 'w') as f:
+      f.write(data)
+    hashes[post['id']] = [h, post['created_utc']]
+    if catalog is not None:
+      catalog.update(post, fn, commit=False)
+    written += 1
+  if catalog is not None:
+    catalog.commit()
+
+  oldest = time.time() - kSecsPerDay * (kDumpWindows[-1] + 1)
+  hashes = {postid: v for postid, v in hashes.items() if v[1] > oldest}
+  with open(hashesPath + '.tmp', 'w') as f:
+    json.dump(hashes, f)
+  os.replace(hashesPath + '.tmp', hashesPath)
+  return written
+
 if __name__ == '__main__':
   print('========' * 4)
   print(f'Starting cronjob.py at {round(time.time())}s ({datetime.fromtimestamp(round(time.time()))})')
@@ -90,124 +420,48 @@ if __name__ == '__main__':
   parser.add_argument('--outdir', '-o', type=str, required=True, help='Directory to dump jsons to')
   parser.add_argument('--subs', '-s', type=str, required=False, default='TheMotte,slatestarcodex,theschism', help='Comma-delimited list of subreddits')
   parser.add_argument('--indexpath', '-ip', type=str, required=False, default='reddit/spot-index', help='Location of spot index')
+  parser.add_argument('--catalog', type=str, required=False, default=None, help='Post catalog to record dumped threads in, if it exists (defaults to catalog.db in outdir)')
+  parser.add_argument('--token-cache', type=str, required=False, default=None, help='sqlite file to keep tokenized comments in between runs (defaults to <indexpath>.tokens.db)')
+  add_policy_args(parser)
   args = parser.parse_args()
 
-  index = spot.Index(args.indexpath)
-
   reddit = Reddit()
 
-  # Step 1: fetch the 100 newest comments from each subreddit.
-  # for subreddit in ['slatestarcodex', 'TheMotte', 'theschism']:
-  for subreddit in args.subs.split(','):
-    T = []
-    r = reddit.request(
-      f"https://www.reddit.com/r/{subreddit}/comments.json?limit={args.num}")
-    assert r['kind'] == 'Listing'
-    comments = r['data']['children']
-
-    oldest_time = min(c['data']['created_utc'] for c in comments)
-
-    print(f'Fetched {subreddit} comments back to %.2f hours ago' % ((time.time() - oldest_time) / 3600))
-
-    # Iterate through comments from old to new so parents are guaranteed to be
-    # inserted first.
-    for comment in comments[::-1]:
-      if comment['kind'] != 't1':
-        print(f'WARNING: Unrecognized comment kind "{comment["kind"]}"')
-      comment = comment['data']
-
-      parts = comment['permalink'].split('/')
-      assert parts[0] == ''
-      assert parts[1] == 'r'
-      assert parts[2] == subreddit
-      assert parts[3] == 'comments'
-      post_id = parts[4]
-      comment_id = parts[6]
-
-      comment = prep_comment_for_insertion(index, comment)
-      # We use 'replace' here so when we insert a comment twice (which is
-      # expected) we don't throw an error.
-      docid = int(comment['id'], 36)
-      index.replace(
-        int(comment['id'], 36),
-        post_id,
-        comment['created_utc'],
-        comment['tokens'].split(' '),
-        comment
-      )
-
-  print('<commit>')
-  index.commit()
-  print('</commit>')
-
-  # Step 2: for all comments either 2 days or 14 days old, refresh.
-  # In practice this means finding all *posts* with comments that are 2 or 14
-  # days old and fetching from them.
-  for days in [2, 14]:
-    a = time.time() - kSecsPerDay * days - kCronjobTimestep
-    b = time.time() - kSecsPerDay * days
-    index.c.execute(f'SELECT docid, postid, json FROM documents WHERE created_utc > {a} AND created_utc < {b}')
-    comments = index.c.fetchall()
-    print(f'refreshing {len(comments)} comments that are {days} days old')
-
-    for i, (docid, postid, oldcomment) in enumerate(comments):
-      print(i, docid)
-      oldcomment = json.loads(oldcomment)
-      permalink = oldcomment['permalink']
-      r = reddit.request(f"https://www.reddit.com{permalink[:-1]}.json")
-      if is_thread(oldcomment):
-        comment = r[0]['data']['children'][0]['data']
-      else:
-        if len(r[1]['data']['children']) == 0:
-          # Missing comment (often deleted).
-          continue
-        comment = r[1]['data']['children'][0]['data']
-      if int(comment['id'], 36) != docid:
-        print('Error (mismatching IDs)')
-        exit(0)
-        continue
-      if comment['author'] != '[deleted]':
-        comment = prep_comment_for_insertion(index, comment)
-        index.replace(
-          docid,
-          postid,
-          comment['created_utc'],
-          comment['tokens'].split(' '),
-          comment
-        )
-
-  print('<commit>')
-  index.commit()
-  print('</commit>')
-
-  # Dump threads into comments.  This doesn't use network so we can do this frequently.
-  for days in [0, 0.5, 1, 1.5, 2, 3, 4, 6, 8, 12, 16, 24]:
-    a = time.time() - kSecsPerDay * days - kCronjobTimestep
-    b = time.time() - kSecsPerDay * days
-    index.c.execute(f'SELECT docid, postid, json FROM documents WHERE created_utc > {a} AND created_utc < {b}')
-    comments = index.c.fetchall()
-    for docid, postid, oldcomment in comments:
-      oldcomment = json.loads(oldcomment)
-      if not is_thread(oldcomment):
-        continue
-
-      # Fetch all comments for a post
-      index.c.execute(f'SELECT json FROM documents WHERE postid == {postid}')
-      C = [json.loads(c[0]) for c in index.c.fetchall()]
-
-      # Separate the post from its comments
-      post = [c for c in C if int(c['id'], 36) == postid]
-      assert len(post) == 1
-      post = post[0]
-      C = [c for c in C if int(c['id'], 36) != postid]
-
-      post['comments'] = C
-      date = datetime.fromtimestamp(post['created_utc'])
-
-      fn = pjoin(args.outdir, str(date.year), post['id'] + '.json')
-      print('dump', fn)
-      with open(fn, 'w') as f:
-        json.dump(post, f, indent=1)
+  # We're a fresh process every run, so unchanged comments are only spared
+  # re-tokenizing if the token cache is on disk.
+  tokenCache.persist(args.indexpath.rstrip('/') + '.tokens.db' if args.token_cache is None else args.token_cache)
+
+  # create_spot_index.py can't publish a new version while we hold the
+  # lock, and carries over the documents we log (see indexversions.py).
+  with lock_index(args.indexpath):
+    index = spot.Index(current_version(args.indexpath))
+    n = migrate_postids(index)
+    if n > 0:
+      print(f'Converted the post ids of {n} posts to integers')
+    index.commit()
+
+    # Step 1: fetch the 100 newest comments from each subreddit.
+    # for subreddit in ['slatestarcodex', 'TheMotte', 'theschism']:
+    written = []
+    for subreddit in args.subs.split(','):
+      written += fetch_comments(index, reddit, subreddit, args.num)
+
+    print('<commit>')
+    index.commit()
+    tokenCache.commit()
+    print('</commit>')
+    log_writes(args.indexpath, written)
+
+    written = refresh_comments(index, reddit, args.refresh_budget, policy_from_args(args), args.archive_budget)
+
+    print('<commit>')
+    index.commit()
+    tokenCache.commit()
+    print('</commit>')
+    log_writes(args.indexpath, written)
+
+  print(f'token cache: {tokenCache.hits} hits, {tokenCache.misses} misses')
+  dump_threads(index, args.outdir, existing_catalog(args.outdir, args.catalog))
 
   index.commit()
 
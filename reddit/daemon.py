@@ -0,0 +1,197 @@
+"""
+Runs the ingestion steps of cronjob2.py and cronjob.py in one long-running
+process instead of a fresh process every 10 minutes, so the Reddit session
+(and its auth token), the spot index, the post catalog, recently used
+threads and the token cache stay loaded between runs.
+
+Each step runs on its own interval (in seconds; 0 disables it):
+
+  fetch:    fetch the newest posts/comments of each subreddit (cronjob2.py)
+  refresh:  re-fetch the posts most worth refreshing (see scheduler.py)
+  index:    apply the change journal to the spot index
+  comments: fetch the newest comments of each subreddit straight into the
+            spot index (cronjob.py's step 1)
+  reindex:  refresh posts in the spot index (cronjob.py's step 2)
+  dump:     dump recent threads from the spot index (see cronjob.py) as raw
+            json files into --dumpdir, which must not be the corpus
+
+Steps that write to the index hold lock_index() (see indexversions.py).
+
+python3 reddit/daemon.py -o reddit/c2
+python3 reddit/daemon.py -o reddit/c2 --fetch-interval 0 --refresh-interval 0 --index-interval 0 \
+  --comments-interval 600 --reindex-interval 600 --dump-interval 600 --dumpdir reddit/comments
+"""
+
+import argparse, time, traceback
+from datetime import datetime
+
+import spot
+
+from cache import add_cache_args, cache_from_args
+from corpus import open_corpus, ThreadCache
+from indexversions import current_version, lock_index, log_writes
+from cronjob import dump_threads, fetch_comments, migrate_postids, refresh_comments
+from catalog import add_catalog_args, existing_catalog, open_catalog
+from cronjob2 import fetch_new, refresh_old
+from journal import ChangeJournal
+from reddit import Reddit
+from scheduler import add_policy_args, policy_from_args
+from update_spot_index import update_index
+
+from utils import *
+
+class Step:
+  def __init__(self, name, interval, fn):
+    self.name = name
+    self.interval = interval
+    self.fn = fn
+    self.nextTime = 0.0
+    self.runs = 0
+    self.failures = 0
+
+  def run(self):
+    startTime = time.time()
+    print(f'<{self.name}>')
+    try:
+      self.fn()
+    except Exception:
+      # Keep going; the step is retried on its next tick.
+      traceback.print_exc()
+      self.failures += 1
+    self.runs += 1
+    print(f'</{self.name}> %.1f seconds' % (time.time() - startTime))
+    self.nextTime = startTime + self.interval
+
+# Runs the steps that are due, oldest due first, sleeping in between.
+# 'after' (if given) is called after every step.  Returns after 'ticks'
+# steps have run (or never, if 'ticks' is None).
+def run_forever(steps, ticks=None, after=None):
+  steps = [step for step in steps if step.interval > 0]
+  if len(steps) == 0:
+    return
+  n = 0
+  while ticks is None or n < ticks:
+    step = min(steps, key=lambda step: step.nextTime)
+    delay = step.nextTime - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    step.run()
+    if after is not None:
+      after()
+    n += 1
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Continuously grab and refresh recent comments')
+  parser.add_argument('--num', '-n', type=int, default=100, help='Number of posts/comments to get')
+  parser.add_argument('--outdir', '-o', type=str, required=True, help='Corpus to write threads to')
+  parser.add_argument('--subs', '-s', type=str, required=False, default='TheMotte,slatestarcodex,theschism', help='Comma-delimited list of subreddits')
+  parser.add_argument('--indexpath', '-ip', type=str, required=False, default='reddit/spot-index', help='Location of spot index')
+  parser.add_argument('--journal', type=str, required=False, default=None, help='Change journal (defaults to journal.jsonl in outdir)')
+  parser.add_argument('--metrics', type=str, required=False, default=None, help='File to write crawl metrics to after every step')
+  parser.add_argument('--thread-cache', type=int, default=1000, help='Number of threads to keep in memory')
+  parser.add_argument('--fetch-interval', type=float, default=600, help='Seconds between fetches of new comments')
+  parser.add_argument('--refresh-interval', type=float, default=600, help='Seconds between refreshes of old posts')
+  parser.add_argument('--index-interval', type=float, default=600, help='Seconds between spot index updates')
+  parser.add_argument('--comments-interval', type=float, default=0, help='Seconds between fetches of new comments straight into the spot index (like cronjob.py)')
+  parser.add_argument('--reindex-interval', type=float, default=0, help='Seconds between refreshes of posts in the spot index (like cronjob.py)')
+  parser.add_argument('--dump-interval', type=float, default=0, help='Seconds between dumps of recent threads from the spot index')
+  parser.add_argument('--token-cache', type=str, required=False, default=None, help='sqlite file to keep tokenized comments in across restarts (defaults to <indexpath>.tokens.db; shared with cronjob.py)')
+  parser.add_argument('--dumpdir', type=str, required=False, default=None, help='Directory to dump threads to (required with --dump-interval; must differ from outdir)')
+  add_cache_args(parser)
+  add_catalog_args(parser)
+  add_policy_args(parser)
+  args = parser.parse_args()
+
+  # Dumped threads bypass the thread cache, the journal and the catalog, so
+  # they mustn't land in the corpus we're maintaining.
+  if args.dump_interval > 0:
+    if args.dumpdir is None:
+      parser.error('--dumpdir is required with --dump-interval')
+    if os.path.realpath(args.dumpdir) == os.path.realpath(args.outdir):
+      parser.error('--dumpdir must be a different directory from --outdir')
+
+  print(f'Starting daemon.py at {round(time.time())}s ({datetime.fromtimestamp(round(time.time()))})')
+
+  reddit = Reddit(cache=cache_from_args(args))
+  if args.comments_interval > 0 or args.reindex_interval > 0:
+    tokenCache.persist(args.indexpath.rstrip('/') + '.tokens.db' if args.token_cache is None else args.token_cache)
+  journalPath = pjoin(args.outdir, 'journal.jsonl') if args.journal is None else args.journal
+  journal = ChangeJournal(journalPath)
+  store = open_corpus(args.outdir, indent=1)
+  catalog = open_catalog(store, args.outdir, args.catalog, args.backfill_catalog)
+  corpus = ThreadCache(store, args.thread_cache)
+  # create_spot_index.py may publish a new version of the index while we
+  # run (see indexversions.py); we switch to it before the next step.
+  indexVersion = current_version(args.indexpath)
+  index = spot.Index(indexVersion)
+
+  def open_index():
+    global index, indexVersion
+    if current_version(args.indexpath) != indexVersion:
+      index.commit()
+      indexVersion = current_version(args.indexpath)
+      index = spot.Index(indexVersion)
+      print(f'Switched to index {indexVersion}')
+    return index
+
+  def fetch():
+    for subreddit in args.subs.split(','):
+      fetch_new(reddit, corpus, catalog, journal, subreddit, args.num)
+
+  policy = policy_from_args(args)
+
+  def refresh():
+    refresh_old(reddit, corpus, catalog, journal, args.refresh_budget, policy, args.archive_budget)
+
+  def update():
+    with lock_index(args.indexpath):
+      entries, replaced, removed = update_index(open_index(), corpus, journal, journalPath + '.offset')
+    print(f'Applied {entries} journal entries ({replaced} documents replaced, {removed} deleted)')
+
+  def comments():
+    with lock_index(args.indexpath):
+      migrate_postids(open_index())
+      written = []
+      for subreddit in args.subs.split(','):
+        written += fetch_comments(open_index(), reddit, subreddit, args.num)
+      open_index().commit()
+      tokenCache.commit()
+      log_writes(args.indexpath, written)
+
+  def reindex():
+    with lock_index(args.indexpath):
+      migrate_postids(open_index())
+      written = refresh_comments(open_index(), reddit, args.refresh_budget, policy, args.archive_budget)
+      open_index().commit()
+      tokenCache.commit()
+      log_writes(args.indexpath, written)
+
+  # The dump directory's own catalog, if it has one.
+  dumpCatalog = None if args.dumpdir is None else existing_catalog(args.dumpdir)
+
+  def dump():
+    dump_threads(open_index(), args.dumpdir, dumpCatalog)
+
+  steps = [
+    Step('fetch', args.fetch_interval, fetch),
+    Step('refresh', args.refresh_interval, refresh),
+    Step('index', args.index_interval, update),
+    Step('comments', args.comments_interval, comments),
+    Step('reindex', args.reindex_interval, reindex),
+    Step('dump', args.dump_interval, dump),
+  ]
+
+  def dump_metrics():
+    print(f'thread cache: {corpus.hits} hits, {corpus.misses} misses')
+    print(f'token cache: {tokenCache.hits} hits, {tokenCache.misses} misses')
+    if args.metrics is not None:
+      reddit.metrics.dump(args.metrics)
+
+  try:
+    run_forever(steps, after=dump_metrics)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    index.commit()
+    catalog.commit()
+    print(f'Ending daemon.py at {round(time.time())}s ({datetime.fromtimestamp(round(time.time()))})')
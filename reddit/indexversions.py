@@ -0,0 +1,102 @@
+"""
+Versioned spot indices, so the index can be rebuilt while it's being
+searched.
+
+Builders write a new version to <path>.versions/<timestamp> and then
+publish() it, which atomically repoints the symlink <path> at it.  Readers
+keep opening <path> (or current_version(path)), so each new request sees
+whichever version was published last, and requests already running keep
+reading the version they opened.  The newest few versions are kept so those
+requests don't lose their file.
+
+Writers that update the current version in place (update_spot_index.py)
+hold a shared lock_index() while they write, and builders hold it
+exclusively while they catch up and publish, so nothing is written to a
+version after it has been replaced.
+
+Writers that don't go through the change journal (cronjob.py) also list
+the documents they write with log_writes() while a build is running, so
+the builder can copy them into the new version before publishing it.
+"""
+
+import fcntl, os, time
+from contextlib import contextmanager
+pjoin = os.path.join
+
+# Versions to keep around after publishing one (including that one).
+kKeepVersions = 2
+
+def versions_dir(path):
+  return path.rstrip('/') + '.versions'
+
+# Returns a path for a new version of the index at 'path'.
+def new_version(path):
+  os.makedirs(versions_dir(path), exist_ok=True)
+  name = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+  version = pjoin(versions_dir(path), name)
+  n = 1
+  while os.path.exists(version):
+    n += 1
+    version = pjoin(versions_dir(path), f'{name}-{n}')
+  return version
+
+# The file 'path' currently refers to.  For an index that predates
+# versioning this is just 'path'.
+def current_version(path):
+  return os.path.realpath(path)
+
+# Locks <path>.lock, shared or exclusive.
+@contextmanager
+def lock_index(path, exclusive=False):
+  with open(path.rstrip('/') + '.lock', 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+def writes_path(path):
+  return path.rstrip('/') + '.writes'
+
+# Starts logging writes to the index at 'path'.  Call with the exclusive
+# lock held.
+def start_write_log(path):
+  open(writes_path(path), 'w').close()
+
+# Records that 'docids' were written to the current version, if a build is
+# running.  Call with the shared lock held, after committing.
+def log_writes(path, docids):
+  if len(docids) == 0 or not os.path.exists(writes_path(path)):
+    return
+  with open(writes_path(path), 'a') as f:
+    f.write(''.join(f'{docid}\n' for docid in docids))
+
+# Stops logging writes and returns the docids written since
+# start_write_log().  Call with the exclusive lock held.
+def finish_write_log(path):
+  if not os.path.exists(writes_path(path)):
+    return []
+  with open(writes_path(path), 'r') as f:
+    docids = set(int(line) for line in f if line.strip())
+  os.remove(writes_path(path))
+  return sorted(docids)
+
+# Makes 'version' the index at 'path' and removes all but the newest
+# 'keep' versions.
+def publish(path, version, keep=kKeepVersions):
+  tmp = path.rstrip('/') + '.tmp-link'
+  if os.path.lexists(tmp):
+    os.remove(tmp)
+  os.symlink(os.path.relpath(version, os.path.dirname(os.path.abspath(path))), tmp)
+  os.replace(tmp, path)
+
+  current = current_version(path)
+  d = versions_dir(path)
+  # Skip manifests and sqlite's own files.
+  names = sorted(fn for fn in os.listdir(d) if not fn.endswith(('.manifest.json', '-journal', '-wal', '-shm')))
+  for fn in names[:-keep] if keep > 0 else names:
+    if os.path.realpath(pjoin(d, fn)) == current:
+      continue
+    for suffix in ['', '.manifest.json', '-journal', '-wal', '-shm']:
+      if os.path.exists(pjoin(d, fn) + suffix):
+        os.remove(pjoin(d, fn) + suffix)
@@ -0,0 +1,89 @@
+"""
+A persistent priority queue of crawl jobs, stored in sqlite.
+
+Each job has a unique key, a kind, a json payload and a priority (higher
+runs first).  Jobs move from "pending" to "running" to "done" (or "failed"
+after too many attempts), and every transition is committed immediately, so
+if a crawl dies the next run picks up where it stopped: jobs that were
+running go back to "pending" when the queue is reopened.
+
+Pass ':memory:' as the path for a queue that doesn't outlive the process.
+"""
+
+import json, sqlite3, threading, time
+
+class Job:
+  def __init__(self, key, kind, payload, priority, attempts):
+    self.key = key
+    self.kind = kind
+    self.payload = payload
+    self.priority = priority
+    self.attempts = attempts
+
+class JobQueue:
+  def __init__(self, path, max_attempts=3):
+    self.maxAttempts = max_attempts
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.c = self.conn.cursor()
+    self.c.execute("""CREATE TABLE IF NOT EXISTS jobs (
+      key TEXT PRIMARY KEY,
+      kind TEXT,
+      payload TEXT,
+      priority REAL,
+      state TEXT,
+      attempts INTEGER,
+      updated REAL
+    )""")
+    self.c.execute('CREATE INDEX IF NOT EXISTS jobs_state_priority ON jobs (state, priority)')
+    # Anything that was running when the last process died starts over.
+    self.c.execute("UPDATE jobs SET state = 'pending' WHERE state = 'running'")
+    self.conn.commit()
+
+  # Adds a job unless one with the same key already exists (in any state).
+  def push(self, key, kind, payload, priority=0.0):
+    with self.lock:
+      self.c.execute(
+        "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, 'pending', 0, ?)",
+        (key, kind, json.dumps(payload), priority, time.time())
+      )
+      self.conn.commit()
+
+  # Claims the highest priority pending job, or returns None.
+  def pop(self):
+    with self.lock:
+      self.c.execute("SELECT key, kind, payload, priority, attempts FROM jobs WHERE state = 'pending' ORDER BY priority DESC, rowid LIMIT 1")
+      row = self.c.fetchone()
+      if row is None:
+        return None
+      key, kind, payload, priority, attempts = row
+      self.c.execute("UPDATE jobs SET state = 'running', attempts = ?, updated = ? WHERE key = ?", (attempts + 1, time.time(), key))
+      self.conn.commit()
+      return Job(key, kind, json.loads(payload), priority, attempts + 1)
+
+  def done(self, job):
+    self._set_state(job.key, 'done')
+
+  # Puts the job back in the queue, unless it has run out of attempts.
+  def fail(self, job):
+    self._set_state(job.key, 'pending' if job.attempts < self.maxAttempts else 'failed')
+
+  def _set_state(self, key, state):
+    with self.lock:
+      self.c.execute('UPDATE jobs SET state = ?, updated = ? WHERE key = ?', (state, time.time(), key))
+      self.conn.commit()
+
+  def counts(self):
+    with self.lock:
+      self.c.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state')
+      return dict(self.c.fetchall())
+
+  # Number of jobs that are pending or running.
+  def unfinished(self):
+    counts = self.counts()
+    return counts.get('pending', 0) + counts.get('running', 0)
+
+  def clear(self):
+    with self.lock:
+      self.c.execute('DELETE FROM jobs')
+      self.conn.commit()
@@ -0,0 +1,84 @@
+"""
+An append-only journal of changes writers make to the corpus, so the search
+index can be brought up to date without a rebuild (see update_spot_index.py).
+
+The journal is a file with one json object per line:
+
+{"time": ..., "postid": "jadgek", "year": 2020,
+ "inserted": [comment ids], "updated": [comment ids], "deleted": [comment ids]}
+
+Consumers remember the byte offset they've read up to.
+"""
+
+import json, os, threading, time
+
+# Returns (inserted, updated, deleted) comment ids going from thread 'old'
+# (which may be None) to thread 'new'.
+def diff_threads(old, new):
+  oldComments = {}
+  if old is not None:
+    for comment in old.get('comments', []):
+      oldComments[comment['id']] = comment
+  inserted, updated = [], []
+  newIds = set()
+  for comment in new.get('comments', []):
+    newIds.add(comment['id'])
+    if comment['id'] not in oldComments:
+      inserted.append(comment['id'])
+    elif oldComments[comment['id']] != comment:
+      updated.append(comment['id'])
+  deleted = [cid for cid in oldComments if cid not in newIds]
+  return inserted, updated, deleted
+
+class ChangeJournal:
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+
+  def append(self, postid, year, inserted=(), updated=(), deleted=()):
+    if len(inserted) + len(updated) + len(deleted) == 0:
+      return
+    line = json.dumps({
+      'time': time.time(),
+      'postid': postid,
+      'year': year,
+      'inserted': list(inserted),
+      'updated': list(updated),
+      'deleted': list(deleted),
+    }) + '\n'
+    with self.lock:
+      with open(self.path, 'a') as f:
+        f.write(line)
+
+  # Journals the difference between two versions of a thread.
+  def record(self, old, new, year):
+    self.append(new['id'], year, *diff_threads(old, new))
+
+  # The offset just past the last complete entry.
+  def end(self):
+    if not os.path.exists(self.path):
+      return 0
+    with open(self.path, 'rb') as f:
+      offset = f.seek(0, os.SEEK_END)
+      while offset > 0:
+        start = max(offset - 4096, 0)
+        f.seek(start)
+        i = f.read(offset - start).rfind(b'\n')
+        if i >= 0:
+          return start + i + 1
+        offset = start
+    return 0
+
+  # Yields (entry, offset just past the entry) for every complete entry
+  # starting at byte 'offset'.
+  def read(self, offset=0):
+    if not os.path.exists(self.path):
+      return
+    with open(self.path, 'rb') as f:
+      f.seek(offset)
+      for line in f:
+        # A writer may be in the middle of appending this line.
+        if not line.endswith(b'\n'):
+          break
+        offset += len(line)
+        yield json.loads(line), offset
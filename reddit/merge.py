@@ -0,0 +1,112 @@
+"""
+Merges freshly fetched comments into threads we already have.
+
+Each thread's comments are kept in a dict keyed by comment id (in their
+original order), so merging a comment is a dict lookup rather than a scan
+of the thread, and we keep track of which threads actually changed so only
+those need to be written out.
+"""
+
+# The default merge policy.  A comment whose author is now "[deleted]" has
+# lost its text, so we keep the version we have (but still take the new
+# score, if 'update_score').  Otherwise the new version wins.
+def merge_comment(old, new, update_score=True):
+  if new['author'] == '[deleted]':
+    if not update_score or 'score' not in new or old.get('score') == new['score']:
+      return old
+    merged = dict(old)
+    merged['score'] = new['score']
+    return merged
+  return new
+
+def comment_postid(comment):
+  # Example: /r/theschism/comments/jadgek/name/g91a2yg/
+  return comment['permalink'].split('/')[4]
+
+# 'inserted' and 'updated' hold the ids of comments that merging added or
+# changed.  If 'new' (i.e. the thread isn't in the corpus yet) all of its
+# comments count as inserted.
+class MergedThread:
+  def __init__(self, post, changed=False, new=False):
+    self.comments = {}
+    for comment in post.get('comments', []):
+      self.comments[comment['id']] = comment
+    self.post = dict(post)
+    self.post.pop('comments', None)
+    self.changed = changed or new
+    self.inserted = set(self.comments) if new else set()
+    self.updated = set()
+
+  # Returns True if the thread changed.
+  def merge(self, comment, policy=merge_comment):
+    old = self.comments.get(comment['id'], None)
+    new = comment if old is None else policy(old, comment)
+    if new is old or new == old:
+      return False
+    if old is None:
+      self.inserted.add(comment['id'])
+    elif comment['id'] not in self.inserted:
+      self.updated.add(comment['id'])
+    self.comments[comment['id']] = new
+    self.changed = True
+    return True
+
+  # Takes the post's new metadata, unless it has been deleted.
+  def update_post(self, post):
+    if post['author'] == '[deleted]':
+      return
+    post = dict(post)
+    post.pop('comments', None)
+    if post != self.post:
+      self.post = post
+      self.changed = True
+
+  def json(self):
+    j = dict(self.post)
+    j['comments'] = list(self.comments.values())
+    return j
+
+class ThreadMerger:
+  def __init__(self, policy=merge_comment):
+    self.policy = policy
+    self.threads = {}
+
+  def __contains__(self, postid):
+    return postid in self.threads
+
+  # 'changed' marks a thread as needing to be written out even if no
+  # comments are merged into it; 'new' means it isn't in the corpus yet.
+  def add(self, post, changed=False, new=False):
+    self.threads[post['id']] = MergedThread(post, changed, new)
+
+  def get(self, postid):
+    return self.threads[postid]
+
+  def merge(self, postid, comment):
+    return self.threads[postid].merge(comment, self.policy)
+
+  # Merges many comments (from any number of posts), one pass per post.
+  # 'load(postid, comments)' is called once for every post we don't have
+  # yet and should return (post, new) (see add()).  Returns the ids of
+  # the posts that changed.
+  def merge_many(self, comments, load=None):
+    byPost = {}
+    for comment in comments:
+      byPost.setdefault(comment_postid(comment), []).append(comment)
+    changed = set()
+    for postid, C in byPost.items():
+      if postid not in self.threads:
+        post, new = load(postid, C)
+        self.add(post, new=new)
+      thread = self.threads[postid]
+      for comment in C:
+        thread.merge(comment, self.policy)
+      if thread.changed:
+        changed.add(postid)
+    return changed
+
+  def changed(self):
+    return [postid for postid, thread in self.threads.items() if thread.changed]
+
+  def json(self, postid):
+    return self.threads[postid].json()
@@ -0,0 +1,106 @@
+"""
+Crawl statistics, broken down by endpoint class (see endpoint()): request
+counts, latency histograms, response bytes, retries, time spent sleeping in
+the throttler, and API calls per comment gathered.
+
+Every Reddit client records into its own CrawlMetrics (reddit.metrics);
+refresh.py and cronjob2.py can dump it with --metrics.
+"""
+
+import json, re, threading, time
+from urllib.parse import urlsplit
+
+# Upper bounds (in seconds) of the latency histogram's buckets.
+kLatencyBuckets = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+def endpoint(url):
+  path = urlsplit(url).path
+  if path.endswith('/access_token'):
+    return 'auth'
+  if path.endswith('/morechildren'):
+    return 'morechildren'
+  if re.fullmatch(r'/r/[^/]+/(new|comments)(\.json)?/?', path):
+    return 'listing'
+  if '/comments/' in path:
+    return 'comments'
+  return 'other'
+
+class EndpointMetrics:
+  def __init__(self):
+    self.requests = 0
+    self.errors = 0
+    self.retries = 0
+    self.cacheHits = 0
+    self.bytes = 0
+    self.latency = 0.0
+    self.maxLatency = 0.0
+    self.throttleSeconds = 0.0
+    self.histogram = [0] * len(kLatencyBuckets)
+
+  def summary(self):
+    return {
+      'requests': self.requests,
+      'errors': self.errors,
+      'retries': self.retries,
+      'cache_hits': self.cacheHits,
+      'bytes': self.bytes,
+      'latency_total': self.latency,
+      'latency_mean': self.latency / self.requests if self.requests > 0 else 0.0,
+      'latency_max': self.maxLatency,
+      'latency_histogram': {
+        str(bound): count for bound, count in zip(kLatencyBuckets, self.histogram)
+      },
+      'throttle_seconds': self.throttleSeconds,
+    }
+
+class CrawlMetrics:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.startTime = time.time()
+    self.endpoints = {}
+    self.comments = 0
+
+  def _get(self, endpoint):
+    if endpoint not in self.endpoints:
+      self.endpoints[endpoint] = EndpointMetrics()
+    return self.endpoints[endpoint]
+
+  def record_request(self, endpoint, latency, numBytes, status, throttleSeconds, isRetry):
+    with self.lock:
+      m = self._get(endpoint)
+      m.requests += 1
+      m.errors += int(status != 200)
+      m.retries += int(isRetry)
+      m.bytes += numBytes
+      m.latency += latency
+      m.maxLatency = max(m.maxLatency, latency)
+      m.throttleSeconds += throttleSeconds
+      for i, bound in enumerate(kLatencyBuckets):
+        if latency <= bound:
+          m.histogram[i] += 1
+          break
+
+  def record_cache_hit(self, endpoint):
+    with self.lock:
+      self._get(endpoint).cacheHits += 1
+
+  # Number of (distinct) comments a crawl produced.
+  def record_comments(self, n):
+    with self.lock:
+      self.comments += n
+
+  def summary(self):
+    with self.lock:
+      requests = sum(m.requests for m in self.endpoints.values())
+      return {
+        'seconds': time.time() - self.startTime,
+        'requests': requests,
+        'comments': self.comments,
+        'requests_per_comment': requests / self.comments if self.comments > 0 else None,
+        'throttle_seconds': sum(m.throttleSeconds for m in self.endpoints.values()),
+        'endpoints': { k: m.summary() for k, m in self.endpoints.items() },
+      }
+
+  def dump(self, path):
+    with open(path, 'w+') as f:
+      json.dump(self.summary(), f, indent=1)
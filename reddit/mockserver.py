@@ -0,0 +1,384 @@
+"""
+A local stand-in for the parts of reddit's API that we crawl, serving
+synthetic threads.  Point a client at it with Reddit(host=server.url, ...).
+
+Endpoints:
+
+/api/v1/access_token
+/comments/<postid>.json?limit=..&sort=..
+/api/morechildren?link_id=..&children=..&sort=..
+/r/<sub>/new(.json)?limit=..&after=..
+/r/<sub>/comments.json?limit=..
+/r/<sub>/comments/<postid>/<slug>/(<commentid>/).json
+
+Comment listings behave like reddit's: at most 'limit' comments are
+returned and the rest of each parent's children are collapsed into "more"
+stubs, which /api/morechildren expands (at most 100 things at a time).
+
+Run standalone with e.g.
+
+python3 reddit/mockserver.py --port 8080 --comments 2000 --latency 0.1
+"""
+
+import argparse, gzip, http.server, json, random, re, threading, time
+from urllib.parse import urlsplit, parse_qs
+
+kMaxMoreChildren = 100
+
+def b36(n):
+  digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+  s = ''
+  while n > 0:
+    n, r = divmod(n, 36)
+    s = digits[r] + s
+  return s or '0'
+
+def listing(children):
+  return {
+    'kind': 'Listing',
+    'data': { 'children': children, 'after': None, 'before': None },
+  }
+
+"""
+A submission and its comment tree.  Each comment's parent is picked at
+random among the post and the earlier comments (up to 'max_depth'); with
+probability 'top_level' it replies to the post directly.
+"""
+class SyntheticThread:
+  def __init__(self, subreddit, postid, created_utc, num_comments, max_depth, top_level, rng):
+    self.subreddit = subreddit
+    self.id = postid
+    slug = f'thread_{postid}'
+    self.permalink = f'/r/{subreddit}/comments/{postid}/{slug}/'
+    self.post = {
+      'id': postid,
+      'name': 't3_' + postid,
+      'title': f'Synthetic thread {postid}',
+      'author': f'user{rng.randrange(1000)}',
+      'created_utc': created_utc,
+      'num_comments': num_comments,
+      'permalink': self.permalink,
+      'subreddit': subreddit,
+      'subreddit_id': 't5_' + b36(abs(hash(subreddit)) % 36**5),
+      'url': 'https://www.reddit.com' + self.permalink,
+      'score': rng.randrange(200),
+      'ups': 0,
+      'selftext': 'Synthetic post body',
+      'selftext_html': '<div class="md"><p>Synthetic post body</p>\n</div>',
+      'distinguished': None,
+    }
+
+    base = int(postid, 36) * 100000
+    self.comments = {}
+    self.children = { postid: [] }
+    depths = {}
+    ids = []
+    for i in range(num_comments):
+      cid = b36(base + i)
+      parent = postid
+      if len(ids) > 0 and rng.random() > top_level:
+        parent = rng.choice(ids)
+        if depths[parent] >= max_depth:
+          parent = postid
+      depths[cid] = 1 if parent == postid else depths[parent] + 1
+      ids.append(cid)
+      self.children[parent].append(cid)
+      self.children[cid] = []
+      score = int(rng.paretovariate(1.2))
+      self.comments[cid] = {
+        'id': cid,
+        'name': 't1_' + cid,
+        'parent_id': ('t3_' if parent == postid else 't1_') + parent,
+        'link_id': 't3_' + postid,
+        'permalink': f'{self.permalink}{cid}/',
+        'subreddit': subreddit,
+        'subreddit_id': self.post['subreddit_id'],
+        'author': f'user{rng.randrange(1000)}',
+        'created_utc': created_utc + 1 + i * 10,
+        'edited': False,
+        'score': score,
+        'ups': score,
+        'controversiality': rng.randrange(2),
+        'depth': depths[cid] - 1,
+        'body': f'comment {cid} about things',
+        'body_html': f'<div class="md"><p>comment {cid} about <a href="https://example.com/{cid}">things</a></p>\n</div>',
+        'distinguished': None,
+        'stickied': False,
+        # Fields we never read, so that projection has something to drop.
+        'all_awardings': [],
+        'gildings': {},
+        'author_flair_richtext': [],
+        'awarders': [],
+        'treatment_tags': [],
+      }
+
+  def sorted_children(self, parent, order, rng):
+    kids = list(self.children[parent])
+    if order == 'new':
+      kids.sort(key=lambda c: -self.comments[c]['created_utc'])
+    elif order == 'old':
+      kids.sort(key=lambda c: self.comments[c]['created_utc'])
+    elif order == 'controversial':
+      kids.sort(key=lambda c: (-self.comments[c]['controversiality'], -self.comments[c]['created_utc']))
+    elif order == 'random':
+      rng.shuffle(kids)
+    else:
+      kids.sort(key=lambda c: -self.comments[c]['score'])
+    return kids
+
+  def subtree(self, cid):
+    R = [cid]
+    for k in self.children[cid]:
+      R += self.subtree(k)
+    return R
+
+  def more(self, parent, hidden):
+    return {
+      'kind': 'more',
+      'data': {
+        'id': hidden[0],
+        'name': 't1_' + hidden[0],
+        'parent_id': ('t3_' if parent == self.id else 't1_') + parent,
+        'count': len(hidden),
+        'children': hidden,
+      },
+    }
+
+  # The comment tree under 'parent', with at most budget[0] comments.
+  def tree(self, parent, order, budget, rng):
+    things = []
+    kids = self.sorted_children(parent, order, rng)
+    for i, cid in enumerate(kids):
+      if budget[0] <= 0:
+        hidden = []
+        for k in kids[i:]:
+          hidden += self.subtree(k)
+        things.append(self.more(parent, hidden))
+        break
+      budget[0] -= 1
+      data = dict(self.comments[cid])
+      replies = self.tree(cid, order, budget, rng)
+      data['replies'] = listing(replies) if len(replies) > 0 else ''
+      things.append({ 'kind': 't1', 'data': data })
+    return things
+
+  def comments_page(self, order, limit, rng):
+    return [
+      listing([{ 'kind': 't3', 'data': self.post }]),
+      listing(self.tree(self.id, order, [limit], rng)),
+    ]
+
+  def morechildren(self, children):
+    children = [c for c in children if c in self.comments]
+    things = []
+    for cid in children[:kMaxMoreChildren]:
+      data = dict(self.comments[cid])
+      data['replies'] = ''
+      things.append({ 'kind': 't1', 'data': data })
+    # Whatever doesn't fit is handed back as another stub.
+    if len(children) > kMaxMoreChildren:
+      things.append(self.more(self.id, children[kMaxMoreChildren:]))
+    return { 'json': { 'errors': [], 'data': { 'things': things } } }
+
+"""
+A set of subreddits, each with 'num_posts' threads posted 'spacing' seconds
+apart (newest first, ending now).
+"""
+class SyntheticReddit:
+  def __init__(self, subreddits=('TheMotte', 'slatestarcodex', 'theschism'), num_posts=5,
+      num_comments=500, max_depth=8, top_level=0.2, spacing=6 * 60 * 60, seed=0):
+    rng = random.Random(seed)
+    now = time.time()
+    self.threads = {}
+    self.posts = {}
+    n = 36**5
+    for subreddit in subreddits:
+      self.posts[subreddit] = []
+      for i in range(num_posts):
+        postid = b36(n)
+        n += 1
+        thread = SyntheticThread(subreddit, postid, now - (i + 1) * spacing, num_comments, max_depth, top_level, rng)
+        self.threads[postid] = thread
+        self.posts[subreddit].append(thread)
+
+  def new(self, subreddit, limit, after):
+    posts = self.posts.get(subreddit, [])
+    start = 0
+    if after is not None:
+      ids = [t.id for t in posts]
+      start = ids.index(after[3:]) + 1 if after[3:] in ids else len(ids)
+    return listing([{ 'kind': 't3', 'data': t.post } for t in posts[start:start + limit]])
+
+  def new_comments(self, subreddit, limit):
+    C = []
+    for t in self.posts.get(subreddit, []):
+      C += t.comments.values()
+    C.sort(key=lambda c: -c['created_utc'])
+    return listing([{ 'kind': 't1', 'data': c } for c in C[:limit]])
+
+  def permalink(self, postid, commentid, rng):
+    thread = self.threads[postid]
+    if commentid is None:
+      return thread.comments_page('confidence', 500, rng)
+    children = []
+    if commentid in thread.comments:
+      data = dict(thread.comments[commentid])
+      data['replies'] = ''
+      children.append({ 'kind': 't1', 'data': data })
+    return [listing([{ 'kind': 't3', 'data': thread.post }]), listing(children)]
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if urlsplit(self.path).path == '/api/v1/access_token':
+      self.reply('auth', 200, { 'access_token': 'mock', 'token_type': 'bearer', 'expires_in': 3600, 'scope': '*' })
+    else:
+      self.reply('other', 404, { 'error': 404 })
+
+  def do_GET(self):
+    parts = urlsplit(self.path)
+    path = parts.path
+    query = { k: v[0] for k, v in parse_qs(parts.query).items() }
+    rng = random.Random(self.path)
+    corpus = self.server.corpus
+    limit = int(query.get('limit', 25))
+
+    m = re.fullmatch(r'/comments/(\w+)(\.json)?', path)
+    if m and m.group(1) in corpus.threads:
+      thread = corpus.threads[m.group(1)]
+      return self.reply('comments', 200, thread.comments_page(query.get('sort', 'confidence'), limit, rng))
+
+    if path == '/api/morechildren':
+      postid = query.get('link_id', '')[3:]
+      if postid not in corpus.threads:
+        return self.reply('morechildren', 404, { 'error': 404 })
+      children = query.get('children', '').split(',')
+      return self.reply('morechildren', 200, corpus.threads[postid].morechildren(children))
+
+    m = re.fullmatch(r'/r/(\w+)/new(\.json)?', path)
+    if m:
+      return self.reply('listing', 200, corpus.new(m.group(1), min(limit, 100), query.get('after', None)))
+
+    m = re.fullmatch(r'/r/(\w+)/comments(\.json)?', path)
+    if m:
+      return self.reply('listing', 200, corpus.new_comments(m.group(1), min(limit, 100)))
+
+    m = re.fullmatch(r'/r/\w+/comments/(\w+)/\w+(/(\w+))?/?(\.json)?', path)
+    if m and m.group(1) in corpus.threads:
+      return self.reply('comments', 200, corpus.permalink(m.group(1), m.group(3), rng))
+
+    self.reply('other', 404, { 'error': 404 })
+
+  def reply(self, endpoint, status, body):
+    server = self.server
+    if server.latency > 0:
+      time.sleep(server.latency)
+
+    headers = {}
+    if server.quota is not None:
+      remaining, reset = server.spend()
+      headers['X-Ratelimit-Used'] = str(server.quota - remaining)
+      headers['X-Ratelimit-Remaining'] = str(float(max(0, remaining)))
+      headers['X-Ratelimit-Reset'] = str(int(reset))
+      if remaining < 0:
+        status, body = 429, { 'message': 'Too Many Requests', 'error': 429 }
+
+    data = json.dumps(body).encode()
+    if 'gzip' in self.headers.get('Accept-Encoding', ''):
+      data = gzip.compress(data)
+      headers['Content-Encoding'] = 'gzip'
+
+    server.record(endpoint, len(data))
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+    self.send_header('Content-Length', str(len(data)))
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.end_headers()
+    self.wfile.write(data)
+
+"""
+'quota' is the number of requests allowed every 'window' seconds (None means
+unlimited).  Each response is delayed by 'latency' seconds.
+"""
+class MockRedditServer(http.server.ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, corpus, latency=0.0, quota=None, window=600, verbose=False):
+    super().__init__(address, Handler)
+    self.corpus = corpus
+    self.latency = latency
+    self.quota = quota
+    self.window = window
+    self.verbose = verbose
+    self.lock = threading.Lock()
+    self.windowStart = time.time()
+    self.used = 0
+    self.stats = {}
+
+  @property
+  def url(self):
+    host, port = self.server_address[:2]
+    return f'http://{host}:{port}'
+
+  # Returns (remaining requests, seconds until reset) after this request.
+  def spend(self):
+    with self.lock:
+      now = time.time()
+      if now - self.windowStart >= self.window:
+        self.windowStart = now
+        self.used = 0
+      self.used += 1
+      return self.quota - self.used, self.window - (now - self.windowStart)
+
+  def record(self, endpoint, numBytes):
+    with self.lock:
+      if endpoint not in self.stats:
+        self.stats[endpoint] = { 'requests': 0, 'bytes': 0 }
+      self.stats[endpoint]['requests'] += 1
+      self.stats[endpoint]['bytes'] += numBytes
+
+  def reset_stats(self):
+    with self.lock:
+      self.stats = {}
+
+# Starts a server on a background thread.  Use port=0 to pick a free port.
+def start(corpus, port=0, **kwargs):
+  server = MockRedditServer(('127.0.0.1', port), corpus, **kwargs)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+# Secret to construct a Reddit client for this server with.
+kMockSecret = {
+  'appid': 'mock',
+  'appsecret': 'mock',
+  'useragent': 'mockserver',
+  'username': 'mock',
+  'password': 'mock',
+}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Serve synthetic reddit API responses')
+  parser.add_argument('--port', '-p', type=int, default=8080, help='Port to listen on')
+  parser.add_argument('--subs', '-s', type=str, required=False, default='TheMotte,slatestarcodex,theschism', help='Comma-delimited list of subreddits')
+  parser.add_argument('--posts', type=int, default=5, help='Posts per subreddit')
+  parser.add_argument('--comments', type=int, default=500, help='Comments per post')
+  parser.add_argument('--max-depth', type=int, default=8, help='Maximum comment depth')
+  parser.add_argument('--top-level', type=float, default=0.2, help='Fraction of comments that reply to the post')
+  parser.add_argument('--latency', type=float, default=0.0, help='Seconds to delay each response by')
+  parser.add_argument('--quota', type=int, default=None, help='Requests allowed per window')
+  parser.add_argument('--window', type=float, default=600, help='Rate limit window in seconds')
+  parser.add_argument('--seed', type=int, default=0, help='Random seed')
+  parser.add_argument('--verbose', '-v', action='store_true', help='Log every request')
+  args = parser.parse_args()
+
+  corpus = SyntheticReddit(args.subs.split(','), args.posts, args.comments, args.max_depth, args.top_level, seed=args.seed)
+  server = MockRedditServer(('127.0.0.1', args.port), corpus, args.latency, args.quota, args.window, args.verbose)
+  print(f'Serving {len(corpus.threads)} threads on {server.url}')
+  server.serve_forever()
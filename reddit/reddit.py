@@ -12,9 +12,11 @@ https://alpscode.com/blog/how-to-use-reddit-api/
 
 """
 
-import json, os, pathlib, requests, time
+import asyncio, concurrent.futures, json, os, pathlib, requests, threading, time, urllib.parse
 pjoin = os.path.join
 
+import metrics
+
 """
 0: no printing
 1: errors
@@ -22,15 +24,70 @@ pjoin = os.path.join
 """
 VERBOSITY = 2
 
+# Safe to share between threads: each caller reserves the next free slot
+# under the lock and then sleeps (outside the lock) until that slot arrives.
 class Throttler:
   def __init__(self, qps):
     self.waitTime = 1. / qps
     self.lastTime = 0
+    self.lock = threading.Lock()
+  # Returns the number of seconds slept.
   def throttle(self):
-    time.sleep(max(0, self.waitTime - (time.time() - self.lastTime)))
-    self.lastTime = time.time()
+    with self.lock:
+      now = time.time()
+      slot = max(now, self.lastTime + self.waitTime)
+      self.lastTime = slot
+    time.sleep(slot - now)
+    return slot - now
+  # Called with the headers of every response.
+  def update(self, headers):
+    pass
+  # Delays every future request by at least 'seconds'.
+  def backoff(self, seconds):
+    with self.lock:
+      self.lastTime = max(self.lastTime, time.time() + seconds - self.waitTime)
+
+"""
+Paces requests using reddit's rate limit headers: whatever remains of the
+current window's budget is spread evenly over the seconds until the window
+resets.  Until the first response arrives we fall back to 'qps'.
+"""
+class AdaptiveThrottler(Throttler):
+  def __init__(self, qps, max_qps=10.0):
+    super().__init__(qps)
+    self.minWaitTime = 1. / max_qps
+  def update(self, headers):
+    try:
+      remaining = float(headers['X-Ratelimit-Remaining'])
+      reset = float(headers['X-Ratelimit-Reset'])
+    except (KeyError, TypeError, ValueError):
+      return
+    if remaining < 1:
+      # The budget is spent; don't send anything until the window resets.
+      self.backoff(reset)
+      return
+    with self.lock:
+      self.waitTime = max(self.minWaitTime, reset / remaining)
+
+kRetryBaseDelay = 2.0
+kRetryMaxDelay = 120.0
+
+# Exponential backoff, unless the server tells us how long to wait.
+def retry_delay(response, attempt):
+  try:
+    return min(kRetryMaxDelay, float(response.headers['Retry-After']))
+  except (KeyError, TypeError, ValueError):
+    return min(kRetryMaxDelay, kRetryBaseDelay * 2 ** attempt)
+
+# reddit returns at most 100 children per morechildren request, and overly
+# long URLs can make the request fail, so we fetch children in batches.
+kMaxChildrenPerRequest = 100
+kMaxUrlLength = 2000
+kMaxConcurrentBatches = 4
 
 class MoreComments:
+  __slots__ = ('reddit', 'json', 'id', 'submission')
+
   def __init__(self, reddit, json, submission):
     assert json['kind'] == 'more'
     self.reddit = reddit
@@ -45,45 +102,122 @@ class MoreComments:
     if len(self.json["children"]) == 0:
       return [], []
 
+    # When re-crawling, the parent may be a comment we already had and so
+    # didn't fetch again.
     pid = self.parent_id()
-    if pid == self.submission.json['id']:
-      link_id = 't3_' + pid
-    elif pid in self.submission.comments:
-      link_id = self.submission.comments[pid].json['link_id']
-    else:
+    submission = self.submission
+    if pid != submission.json['id'] and pid not in submission.comments and pid not in submission.known_ids:
       raise Exception('A "MoreComment" should always have an existing parent')
+    link_id = 't3_' + submission.json['id']
 
-    # TODO: with too many children it's possible for this URL to be too long,
-    # which can make this request fail.
-    url = f'https://api.reddit.com/api/morechildren?api_type=json&link_id={link_id}&children={",".join(self.json["children"])}&order={self.submission.order}'
-    result = self.reddit.request(url)
-    if result is None:
-      return [], []
-    assert len(result['json']['errors']) == 0
+    # Batches are independent, so we send them all at once.
+    batches = self.batches(link_id)
+    if len(batches) == 1:
+      results = [self._fetch_batch(link_id, batches[0])]
+    else:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(batches), kMaxConcurrentBatches)) as executor:
+        results = list(executor.map(lambda batch: self._fetch_batch(link_id, batch), batches))
 
-    children = result['json']['data']['things']
-    
     comments, mores = [], []
-    for child in children:
-      assert child['kind'] in ['t1', 'more'], child['kind']
-      if child['kind'] == 'more':
-        mores.append(MoreComments(self.reddit, child, self.submission))
-      elif child['kind'] == 't1':
-        comments.append(Comment(child))
+    seenit = set()
+    for children in results:
+      for child in children:
+        assert child['kind'] in ['t1', 'more'], child['kind']
+        if child['data']['id'] in seenit:
+          continue
+        seenit.add(child['data']['id'])
+        if child['kind'] == 'more':
+          mores.append(MoreComments(self.reddit, child, self.submission))
+        elif child['kind'] == 't1':
+          comments.append(Comment(child, submission.fields))
 
     return comments, mores
 
+  def _url(self, link_id, children):
+    return f'https://api.reddit.com/api/morechildren?api_type=json&link_id={link_id}&children={",".join(children)}&order={self.submission.order}'
+
+  # Splits our children into lists that reddit will accept in one request:
+  # at most kMaxChildrenPerRequest ids, and a URL no longer than kMaxUrlLength.
+  def batches(self, link_id):
+    batches = [[]]
+    length = len(self._url(link_id, []))
+    for child in self.json['children']:
+      batch = batches[-1]
+      if len(batch) > 0 and (len(batch) >= kMaxChildrenPerRequest or length + len(child) + 1 > kMaxUrlLength):
+        batch = []
+        batches.append(batch)
+        length = len(self._url(link_id, []))
+      length += len(child) + (1 if len(batch) > 0 else 0)
+      batch.append(child)
+    return batches
+
+  # Returns the raw "things" for one batch of children.  If the request fails
+  # we only lose this batch rather than the whole subtree.  request() gives
+  # None (403) or the last response (once it runs out of retries) on
+  # failure, and reddit can also answer 200 with errors.
+  def _fetch_batch(self, link_id, children):
+    result = self.reddit.request(self._url(link_id, children))
+    if not isinstance(result, dict) or 'json' not in result:
+      if VERBOSITY > 0:
+        print(f'WARNING: skipping {len(children)} comments of {link_id} ({result})')
+      return []
+    if len(result['json'].get('errors', [])) > 0:
+      if VERBOSITY > 0:
+        print(f'WARNING: skipping {len(children)} comments of {link_id} ({result["json"]["errors"]})')
+      return []
+    return result['json']['data']['things']
+
+# The fields of a comment that we actually read (in utils.get_tokens,
+# create_spot_index.py, cronjob2.py and template.html).  Pass this as
+# 'fields' to drop everything else (awards, flair, etc.) at parse time.
+kCommentFields = (
+  'id', 'name', 'parent_id', 'link_id', 'permalink', 'subreddit', 'subreddit_id',
+  'author', 'created_utc', 'edited', 'score', 'ups', 'body', 'body_html',
+  'distinguished', 'stickied',
+)
+
+# Comments with the same keys share one tuple of field names.
+_kFieldTuples = {}
+
+"""
+Stores a comment's values in a tuple (with a shared tuple of field names)
+rather than keeping reddit's json dict.  If 'fields' is given, only those
+fields are kept.  'json' rebuilds the dict.
+"""
 class Comment:
-  def __init__(self, json):
+  __slots__ = ('id', 'fields', 'values')
+
+  def __init__(self, json, fields=None):
     assert json['kind'] == 't1', json['kind']
-    self.json = json['data']
-    self.id = self.json['id']
+    data = json['data']
+    if fields is None:
+      keys = tuple(data)
+    else:
+      keys = tuple(k for k in fields if k in data)
+    self.fields = _kFieldTuples.setdefault(keys, keys)
+    self.values = tuple(data[k] for k in keys)
+    self.id = data['id']
+
+  @property
+  def json(self):
+    return dict(zip(self.fields, self.values))
 
 class Submission:
-  def __init__(self, reddit, submission_id, order):
+  # If concurrency > 1, all outstanding MoreComments at each level are
+  # expanded at the same time (see _fetch_mores_async).
+  #
+  # 'known_ids' are ids of comments we already have (e.g. on disk).  Those
+  # are not requested through morechildren again; the ones we skip are
+  # recorded in self.skipped.
+  #
+  # 'fields' is passed on to Comment (e.g. kCommentFields).
+  def __init__(self, reddit, submission_id, order, concurrency=1, known_ids=None, fields=None):
     assert order in ['confidence', 'top', 'new', 'controversial', 'old', 'random', 'qa', 'live']
     self.order = order
     self.reddit = reddit
+    self.known_ids = set() if known_ids is None else set(known_ids)
+    self.skipped = set()
+    self.fields = fields
 
     # url = f'https://api.reddit.com/comments/{submission_id}/api/comments&api_type=json&limit=100&sort={order}'
     url = f'https://api.reddit.com/comments/{submission_id}.json?limit=500&sort={order}'
@@ -110,6 +244,8 @@ class Submission:
     self.seenit = set()
     self.mores = []
     self._process_list(children)
+    if concurrency > 1:
+      asyncio.run(self._fetch_mores_async(concurrency))
     while len(self.mores):
       newMores = []
       for more in self.mores:
@@ -120,10 +256,7 @@ class Submission:
     for c in listing:
       assert c['kind'] in ['t1', 'more']
       if c['kind'] == 'more':
-        m = MoreComments(self.reddit, c, self)
-        if m.id not in self.seenit:
-          self.seenit.add(m.id)
-          self.mores.append(m)
+        self._queue(MoreComments(self.reddit, c, self), self.mores)
         assert 'replies' not in c['data']
       else:
         if 'replies' in c['data']:
@@ -131,23 +264,51 @@ class Submission:
           del c['data']['replies']
         else:
           r = None
-        c = Comment(c)
+        c = Comment(c, self.fields)
         self.comments[c.id] = c
         if r:
           assert r['kind'] == 'Listing'
           self._process_list(r['data']['children'])
 
+  def _queue(self, more, queue):
+    if more.id in self.seenit:
+      return
+    self.seenit.add(more.id)
+    if len(self.known_ids) > 0:
+      children = more.json['children']
+      self.skipped.update(c for c in children if c in self.known_ids)
+      more.json['children'] = [c for c in children if c not in self.known_ids]
+      if len(more.json['children']) == 0:
+        return
+    queue.append(more)
+
+  # The Reddit client is synchronous, so requests run on a thread pool.  They
+  # all go through self.reddit's throttler, so throughput is bounded by the
+  # rate limit rather than by per-request latency.
+  async def _fetch_mores_async(self, concurrency):
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+      while len(self.mores):
+        results = await asyncio.gather(*[
+          loop.run_in_executor(executor, more.fetch) for more in self.mores
+        ])
+        newMores = []
+        for comments, mores in results:
+          newMores += self._add(comments, mores)
+        self.mores = newMores
+
   def _more(self, more):
-    newMores = []
     comments, mores = more.fetch()
+    return self._add(comments, mores)
+
+  def _add(self, comments, mores):
+    newMores = []
     for c in comments:
       assert c.id not in self.comments
       assert type(c) is Comment
       self.comments[c.id] = c
     for m in mores:
-      if m.id not in self.seenit:
-        newMores.append(m)
-        self.seenit.add(m.id)
+      self._queue(m, newMores)
     if VERBOSITY > 1:
       print(len(self.comments), 'comments')
     return newMores
@@ -158,29 +319,65 @@ Maintains reddit authentication, responsible for throttling, and
 fulfills api requests (trying multiple times if necessary).
 """
 class Reddit:
-  def __init__(self):
-    secretPath = pathlib.Path(__file__).parent.absolute()
-    with open(pjoin(secretPath, 'secret.json'), 'r') as f:
-      self.secret = json.load(f)
+  # 'pool_size' is the number of keep-alive connections kept open per host;
+  # it should be at least the crawl concurrency.
+  #
+  # 'cache' is an optional ResponseCache (see cache.py) consulted before
+  # every request.
+  #
+  # 'secret' overrides secret.json and 'host' (e.g. "http://localhost:8080")
+  # redirects every request to another server, such as mockserver.py.
+  def __init__(self, pool_size=10, cache=None, secret=None, host=None):
+    if secret is None:
+      secretPath = pathlib.Path(__file__).parent.absolute()
+      with open(pjoin(secretPath, 'secret.json'), 'r') as f:
+        secret = json.load(f)
+    self.secret = secret
+    self.host = host
     self.appid = self.secret['appid']
     self.appsecret = self.secret['appsecret']
     self.useragent = self.secret['useragent']
-    # In practice 0.4 works well, but since this is used by non-interactive jobs, we just set it to 1.0
-    self.throttler = Throttler(1.0)
+    # Starts at 1 QPS and then follows reddit's X-Ratelimit-* headers.
+    self.throttler = AdaptiveThrottler(1.0)
+
+    # Reuse connections (and their TLS handshakes) across requests.
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self.session.headers.update({
+      'User-Agent': self.useragent,
+      'Accept-Encoding': 'gzip, deflate',
+    })
+
+    self.cache = cache
+    self.metrics = metrics.CrawlMetrics()
 
     self.expiresAt = 0
-    self.authenticate()
+    self.authLock = threading.Lock()
+    # Replaying from the cache doesn't need (or have) network access.
+    if cache is None or not cache.replay:
+      self.authenticate()
 
   # Refreshes self.auth if necessary.
   def authenticate(self):
     # We add a 1 minute buffer just to be safe.
     if time.time() + 60 < self.expiresAt:
       return
+    with self.authLock:
+      # Another thread may have refreshed while we waited for the lock.
+      if time.time() + 60 < self.expiresAt:
+        return
+      self._authenticate()
+
+  def _authenticate(self):
     if VERBOSITY > 0:
       print('authenticating')
-    self.throttler.throttle()
-    r = requests.post(
-      'https://www.reddit.com/api/v1/access_token',
+    url = 'https://www.reddit.com/api/v1/access_token'
+    slept = self.throttler.throttle()
+    start = time.time()
+    r = self.session.post(
+      self._route(url),
       data = {
         'grant_type': 'password',
         'username': self.secret['username'],
@@ -189,9 +386,17 @@ class Reddit:
       headers = { 'user-agent': self.useragent },
       auth = requests.auth.HTTPBasicAuth(self.appid, self.appsecret)
     )
+    self.metrics.record_request('auth', time.time() - start, len(r.content), r.status_code, slept, False)
     self.auth = r.json()
     self.expiresAt = time.time() + self.auth['expires_in']
 
+  # Points 'url' at self.host, if we have one.
+  def _route(self, url):
+    if self.host is None:
+      return url
+    parts = urllib.parse.urlsplit(url)
+    return self.host + parts.path + ('?' + parts.query if parts.query else '')
+
   # Get the most recent submissions.  We can fetch a maximum of 100 at
   # a time, so we fetch 100 and use the oldest post for the next fetch's
   # "before" parameter.  We continue fetching until we have at least
@@ -244,68 +449,89 @@ class Reddit:
   def request(self, url, max_tries=3, headers=None):
     assert max_tries > 0
 
-    # Refresh authentication if necessary.
-    self.authenticate()
+    endpoint = metrics.endpoint(url)
+
+    if self.cache is not None:
+      response = self.cache.get(url)
+      if response is not None:
+        self.metrics.record_cache_hit(endpoint)
+      if response is not None or self.cache.replay:
+        return response
+
+    for attempt in range(max_tries):
+      # Refresh authentication if necessary.
+      self.authenticate()
+
+      # Create headers.
+      h = {} if headers is None else dict(headers)
+      if 'Authorization' not in h:
+        h['Authorization'] = self.auth['access_token']
+      if 'User-Agent' not in h:
+        h['User-Agent'] = self.useragent
+
+      # Make request.
+      slept = self.throttler.throttle()
+      start = time.time()
+      response = self.session.get(self._route(url), headers=h)
+      self.metrics.record_request(endpoint, time.time() - start, len(response.content), response.status_code, slept, attempt > 0)
+      self.throttler.update(response.headers)
+      if response.status_code == 200:
+        j = response.json()
+        if self.cache is not None:
+          self.cache.put(url, j)
+        return j
+
+      # IF there was an error, print it out.
+      if VERBOSITY > 0:
+        print(response)
 
-    # Create headers.
-    if headers is None:
-      headers = {}
-    if 'Authorization' not in headers:
-      headers['Authorization'] = self.auth['access_token']
-    if 'User-Agent' not in headers:
-      headers['User-Agent'] = self.useragent
+      # Errors that are forbidden generally can't be satisfied by retrying,
+      # so we don't bother.
+      if response.status_code == 403:
+        return None
 
-    # Make request.
-    self.throttler.throttle()
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-      return response.json()
+      # Rate limiting (429) and server errors mean reddit wants us to slow
+      # down, so back off exponentially before retrying.  This goes through
+      # the throttler so that every thread sharing it backs off too.  Other
+      # errors are retried straight away, without stalling other threads.
+      if attempt + 1 < max_tries and (response.status_code == 429 or response.status_code >= 500):
+        self.throttler.backoff(retry_delay(response, attempt))
 
-    # IF there was an error, print it out.
-    if VERBOSITY > 0:
-      print(response)
+    return response
 
-    # Errors that are forbidden generally can't be satisfied by retrying,
-    # so we don't bother.
-    if response.status_code == 403:
-      return None
 
-    # Recursively retry...
-    if max_tries > 1:
-      time.sleep(3)
-      return self.request(url, max_tries - 1)
-    else:
-      return response
+# Orderings to re-crawl large submissions with (after 'new').
+kExtraOrders = ['old', 'top', 'controversial', 'random']
 
+# See Submission for 'concurrency', 'known_ids' and 'fields'.  Known
+# comments that weren't fetched again are not included in the result.
+def create_submission(reddit, submission_id, concurrency=1, early_stop=True, known_ids=None, fields=None):
+  known_ids = set() if known_ids is None else set(known_ids)
+  submission = Submission(reddit, submission_id, order='new', concurrency=concurrency, known_ids=known_ids, fields=fields)
 
-def create_submission(reddit, submission_id):
-  submission = Submission(reddit, submission_id, order='new')
+  # We hold on to the compact Comments until the end.
+  C = dict(submission.comments)
 
   # We cannot consistently find all comments when there are more than
   # 400 comments in a submission (some flaw with reddit's API?) but if
   # we request with many different orders we can typically find (almost?)
   # every comment.
+  #
+  # With early_stop we merge each ordering as it arrives and don't start
+  # another once we've seen num_comments comments, or once an ordering
+  # turns up nothing new.
   if submission.json['num_comments'] > 400:
-    S2 = Submission(reddit, submission.id, order='old')
-    S3 = Submission(reddit, submission.id, order='top')
-    S4 = Submission(reddit, submission.id, order='controversial')
-    S5 = Submission(reddit, submission.id, order='random')
-    C = {}
-    for k in submission.comments:
-      C[k] = S1.comments[k].json
-    for k in S2.comments:
-      C[k] = S2.comments[k].json
-    for k in S3.comments:
-      C[k] = S3.comments[k].json
-    for k in S4.comments:
-      C[k] = S4.comments[k].json
-    for k in S5.comments:
-      C[k] = S5.comments[k].json
-    submission.comments = C
-  else:
-    C = submission.comments
-    submission.comments = {}
-    for k in C:
-      submission.comments[k] = C[k].json
+    for order in kExtraOrders:
+      if early_stop and len(known_ids.union(C)) >= submission.json['num_comments']:
+        break
+      S = Submission(reddit, submission.id, order=order, concurrency=concurrency, known_ids=known_ids, fields=fields)
+      numBefore = len(C)
+      C.update(S.comments)
+      if early_stop and len(C) == numBefore:
+        break
 
+  submission.comments = {}
+  for k in C:
+    submission.comments[k] = C[k].json
+  reddit.metrics.record_comments(len(C))
   return submission
@@ -1,62 +1,149 @@
-import argparse, json, os
+import argparse, concurrent.futures, os, time, traceback
 from datetime import datetime
 
 pjoin = os.path.join
 
-from reddit import Reddit, Submission, create_submission
+from cache import add_cache_args, cache_from_args
+from catalog import add_catalog_args, open_catalog
+from corpus import open_corpus
+from jobqueue import JobQueue
+from journal import ChangeJournal
+from reddit import Reddit, Submission, create_submission, kCommentFields
 
 kSecsPerDay = 60*60*24 # 86_400
 
-def refresh(reddit, subreddits, days, outdir):
-  if not os.path.exists(outdir):
-    os.mkdir(outdir)
+# Listing jobs run before any submission job so the queue fills up quickly.
+# Submissions are prioritized by creation time (newest first).
+kListingPriority = 1e18
 
-  # r/TheMotte is typically very slow per comment on account of its habit
-  # of having threads with over 400 comments.
-  for subreddit in subreddits:
-    # Grab all posts within the last time period
-    S = reddit.new_submissions(subreddit, max_age=kSecsPerDay*days)
-
-    # Grab all comments for these posts
-    for s in S:
-      fn = s['id'] + '.json'
-      year = str(datetime.utcfromtimestamp(s['created_utc']).year)
-      print('https://www.reddit.com' + s['permalink'])
+def refresh_submission(reddit, s, corpus, concurrency=1, full=False, fields=kCommentFields, journal=None, catalog=None):
+  year = datetime.utcfromtimestamp(s['created_utc']).year
+  print('https://www.reddit.com' + s['permalink'])
 
-      submission = create_submission(reddit, s['id'])
+  onDisk = corpus.get(s['id'], year)
+  old = {'comments': []} if onDisk is None else onDisk
 
-      if not os.path.exists(pjoin(outdir, year)):
-        os.mkdir(pjoin(outdir, year))
+  # Unless we're doing a full refresh, only fetch comments we don't have.
+  known_ids = None if full else set(c['id'] for c in old['comments'])
+  submission = create_submission(reddit, s['id'], concurrency=concurrency, known_ids=known_ids, fields=fields)
 
-      if os.path.exists(pjoin(outdir, year, fn)):
-        with open(pjoin(outdir, year, fn), 'r') as f:
-          old = json.load(f)
-      else:
-        old = {'comments': []}
+  # Copy over old comments.
+  for c in old['comments']:
+    if c['id'] not in submission.comments:
+      submission.comments[c['id']] = c
 
-      # Copy over old comments.
-      for c in old['comments']:
-        if c['id'] not in submission.comments:
-          submission.comments[c['id']] = c
+  print(len(submission.comments), 'out of', submission.json['num_comments'])
 
-      print(len(submission.comments), 'out of', submission.json['num_comments'])
+  j = submission.json
+  j['comments'] = list(submission.comments.values())
 
-      j = submission.json
-      j['comments'] = list(submission.comments.values())
+  location = corpus.put(j)
+  if catalog is not None:
+    catalog.update(j, location)
+  if journal is not None:
+    journal.record(onDisk, j, year)
 
-      with open(pjoin(outdir, year, fn), 'w+') as f:
-        json.dump(j, f)
+def run_job(reddit, queue, job, corpus, **kwargs):
+  if job.kind == 'listing':
+    # Grab all posts within the last time period
+    S = reddit.new_submissions(job.payload['subreddit'], max_age=kSecsPerDay*job.payload['days'])
+    for s in S:
+      payload = { 'id': s['id'], 'created_utc': s['created_utc'], 'permalink': s['permalink'] }
+      queue.push('submission:' + s['id'], 'submission', payload, priority=s['created_utc'])
+  elif job.kind == 'submission':
+    refresh_submission(reddit, job.payload, corpus, **kwargs)
+  else:
+    raise Exception(f'Unrecognized job kind "{job.kind}"')
+
+def worker(reddit, queue, corpus, **kwargs):
+  while True:
+    job = queue.pop()
+    if job is None:
+      # Another worker may still be adding jobs.
+      if queue.unfinished() == 0:
+        return
+      time.sleep(1)
+      continue
+    try:
+      run_job(reddit, queue, job, corpus, **kwargs)
+      queue.done(job)
+    except Exception:
+      print(f'Error running job {job.key} (attempt {job.attempts})')
+      traceback.print_exc()
+      queue.fail(job)
+
+# Crawl work goes through 'queue' (a JobQueue).  If it still has unfinished
+# jobs from an earlier run, we finish those (and ignore 'subreddits' and
+# 'days', which they were queued with) if 'resume' is set, and refuse to run
+# otherwise.  With 'resume' and nothing to finish we start a new run.
+#
+# 'outdir' may be a directory of json files or a packed corpus (see corpus.py).
+# Changes are written to 'journal' (a ChangeJournal), if given, and every
+# post written is recorded in the post catalog (see catalog.py).
+def refresh(reddit, subreddits, days, outdir, concurrency=1, full=False, fields=kCommentFields, queue=None, workers=1, journal=None, catalog_path=None, resume=False, backfill=False):
+  os.makedirs(outdir, exist_ok=True)
+  corpus = open_corpus(outdir)
+  catalog = open_catalog(corpus, outdir, catalog_path, backfill)
+
+  if queue is None:
+    queue = JobQueue(':memory:')
+
+  if queue.unfinished() > 0:
+    if not resume:
+      raise Exception(f'The queue has unfinished jobs from an earlier run {queue.counts()}; pass --resume to finish them')
+    print(f'Resuming previous run {queue.counts()} (its subreddits and days are used, not ours)')
+  else:
+    queue.clear()
+    # r/TheMotte is typically very slow per comment on account of its habit
+    # of having threads with over 400 comments.
+    for subreddit in subreddits:
+      queue.push('listing:' + subreddit, 'listing', { 'subreddit': subreddit, 'days': days }, priority=kListingPriority)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = [
+      executor.submit(worker, reddit, queue, corpus, concurrency=concurrency, full=full, fields=fields, journal=journal, catalog=catalog)
+      for _ in range(workers)
+    ]
+    for future in futures:
+      future.result()
+
+  print('Finished', queue.counts())
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='Recursively grab comments from every post in the last few days')
   parser.add_argument('--days', '-d', type=float, required=True, help='Number of days')
-  parser.add_argument('--outdir', '-o', type=str, required=True, help='Directory to dump jsons to')
+  parser.add_argument('--outdir', '-o', type=str, required=True, help='Directory (or packed corpus) to dump jsons to')
   parser.add_argument('--subs', '-s', type=str, required=False, default='TheMotte,slatestarcodex,theschism', help='Comma-delimited list of subreddits')
+  parser.add_argument('--concurrency', '-c', type=int, required=False, default=1, help='Number of "more comments" requests to have in flight at once')
+  parser.add_argument('--full', action='store_true', help='Re-download comments we already have on disk')
+  parser.add_argument('--all-fields', action='store_true', help='Keep every field reddit returns for a comment, not just kCommentFields')
+  parser.add_argument('--queue', '-q', type=str, required=False, default=None, help='sqlite file to keep the job queue in, so an interrupted run can be resumed')
+  parser.add_argument('--resume', action='store_true', help='Finish the unfinished jobs in --queue (with the arguments they were queued with) instead of refusing to run')
+  parser.add_argument('--workers', '-w', type=int, required=False, default=1, help='Number of submissions to crawl at once')
+  parser.add_argument('--journal', type=str, required=False, default=None, help='Change journal (defaults to journal.jsonl in outdir)')
+  parser.add_argument('--metrics', type=str, required=False, default=None, help='File to write crawl metrics to')
+  add_cache_args(parser)
+  add_catalog_args(parser)
   args = parser.parse_args()
 
-  reddit = Reddit()
+  reddit = Reddit(cache=cache_from_args(args))
 
   subreddits = args.subs.split(',')
 
-  refresh(reddit, subreddits, args.days, args.outdir)
-
+  queue = None if args.queue is None else JobQueue(args.queue)
+
+  refresh(
+    reddit, subreddits, args.days, args.outdir,
+    concurrency=args.concurrency,
+    full=args.full,
+    fields=None if args.all_fields else kCommentFields,
+    queue=queue,
+    workers=args.workers,
+    journal=ChangeJournal(pjoin(args.outdir, 'journal.jsonl') if args.journal is None else args.journal),
+    catalog_path=args.catalog,
+    backfill=args.backfill_catalog,
+    resume=args.resume,
+  )
+
+  if args.metrics is not None:
+    reddit.metrics.dump(args.metrics)
@@ -0,0 +1,148 @@
+"""
+Chooses which posts to refresh.  Each run gets a budget of API requests,
+which is spent on the posts most likely to have changed since we last saw
+them, instead of on a fixed number of posts (cronjob2.py) or on every
+comment at fixed ages (cronjob.py).
+
+A post is a dict with "postid", "created_utc", "last_refreshed" (0.0 if
+never) and "num_comments", e.g. a row of the post catalog (see
+PostCatalog.candidates()).
+
+The "value" policy scores a post by
+
+  velocity^velocity_weight * staleness^staleness_weight / age^age_weight
+
+where velocity is comments per day over the post's life, staleness is days
+since we last saw it and age is its age in days.  Posts are then taken in
+order of score per (estimated) request until the budget runs out.
+
+The "once" policy is the old cronjob2.py behaviour: refresh every post once,
+when it is 'min_age' old, newest first.
+
+Whatever the policy, schedule_with_archive() first spends up to
+--archive-budget requests the "once" way, so every post still gets a final
+refresh after two weeks (like cronjob.py and cronjob2.py used to), even
+posts the "value" policy no longer looks at.
+"""
+
+import math, time
+
+from reddit import kMaxChildrenPerRequest
+
+kSecsPerHour = 60 * 60
+kSecsPerDay = 60 * 60 * 24
+
+# Comments returned by a submission's first request (see Submission).
+kCommentsPerListing = 500
+
+kDefaultBudget = 30
+kDefaultArchiveBudget = 10
+
+# The number of requests refreshing 'post' takes, if every "more comments"
+# stub has to be expanded.
+def estimate_cost(post):
+  n = max(post['num_comments'] - kCommentsPerListing, 0)
+  return 1 + math.ceil(n / kMaxChildrenPerRequest)
+
+class RefreshPolicy:
+  def __init__(self, velocity_weight=1.0, staleness_weight=1.0, age_weight=1.0, min_age=0.0, max_age=kSecsPerDay * 30, min_interval=kSecsPerHour * 6):
+    self.velocityWeight = velocity_weight
+    self.stalenessWeight = staleness_weight
+    self.ageWeight = age_weight
+    self.minAge = min_age
+    self.maxAge = max_age
+    self.minInterval = min_interval
+
+  # Higher is more worth refreshing; 0 means don't.
+  def score(self, post, now):
+    age = now - post['created_utc']
+    staleness = now - max(post['last_refreshed'], post['created_utc'])
+    if age < self.minAge or age > self.maxAge or staleness < self.minInterval:
+      return 0.0
+    age = max(age, kSecsPerHour) / kSecsPerDay
+    velocity = (1 + post['num_comments']) / age
+    staleness = staleness / kSecsPerDay
+    return velocity ** self.velocityWeight * staleness ** self.stalenessWeight / age ** self.ageWeight
+
+  def priority(self, post, now, cost):
+    return self.score(post, now) / cost
+
+  # The posts in 'catalog' this policy might refresh.
+  def candidates(self, catalog):
+    return catalog.candidates(self.minAge, self.maxAge)
+
+class OncePolicy(RefreshPolicy):
+  def __init__(self, min_age=kSecsPerDay * 14, max_age=float('inf')):
+    super().__init__(min_age=min_age, max_age=max_age, min_interval=0.0)
+
+  # A post is due once it's 'min_age' old, until it's refreshed (by any
+  # policy) at that age or later, or it's older than 'max_age'.
+  def score(self, post, now):
+    age = now - post['created_utc']
+    if post['last_refreshed'] >= post['created_utc'] + self.minAge or age < self.minAge or age > self.maxAge:
+      return 0.0
+    return post['created_utc']
+
+  # Scores aren't values here, so don't weigh them by cost.
+  def priority(self, post, now, cost):
+    return self.score(post, now)
+
+  def candidates(self, catalog):
+    return catalog.candidates(self.minAge, self.maxAge, refreshed_before_age=self.minAge)
+
+# Returns the posts to refresh, best first, whose estimated costs add up to
+# at most 'budget' requests.
+def schedule(posts, budget, policy, now=None, cost=estimate_cost):
+  if now is None:
+    now = time.time()
+  ranked = []
+  for post in posts:
+    c = cost(post)
+    if policy.score(post, now) > 0.0:
+      ranked.append((policy.priority(post, now, c), c, post))
+  ranked.sort(key=lambda x: -x[0])
+
+  R = []
+  for _, c, post in ranked:
+    if c > budget:
+      continue
+    R.append(post)
+    budget -= c
+  return R
+
+# Like schedule(), but first spends up to 'archive_budget' requests on posts
+# due their final refresh (see OncePolicy), then the rest on 'policy'.
+# 'source' is a PostCatalog or anything else with its candidates().
+# 'archive' defaults to OncePolicy(), which works through every post ever
+# seen; pass one with a max_age to only look at recent posts.
+def schedule_with_archive(source, budget, policy, archive_budget=kDefaultArchiveBudget, now=None, cost=estimate_cost, archive=None):
+  if isinstance(policy, OncePolicy) or archive_budget <= 0:
+    return schedule(policy.candidates(source), budget, policy, now, cost)
+  if archive is None:
+    archive = OncePolicy()
+  R = schedule(archive.candidates(source), min(archive_budget, budget), archive, now, cost)
+  chosen = set(post['postid'] for post in R)
+  budget -= sum(cost(post) for post in R)
+  R += schedule([post for post in policy.candidates(source) if post['postid'] not in chosen], budget, policy, now, cost)
+  return R
+
+def add_policy_args(parser):
+  parser.add_argument('--refresh-policy', type=str, required=False, default='value', choices=['value', 'once'], help='"value" spends the budget on the posts most likely to have changed; "once" refreshes every post once, 2 weeks after it was made')
+  parser.add_argument('--refresh-budget', type=int, required=False, default=kDefaultBudget, help='API requests to spend on refreshes per run')
+  parser.add_argument('--archive-budget', type=int, required=False, default=kDefaultArchiveBudget, help='Requests (out of --refresh-budget) to spend on posts due their final refresh, 2 weeks after they were made')
+  parser.add_argument('--velocity-weight', type=float, required=False, default=1.0, help='Exponent of comments per day in a post\'s score')
+  parser.add_argument('--staleness-weight', type=float, required=False, default=1.0, help='Exponent of days since the last refresh in a post\'s score')
+  parser.add_argument('--age-weight', type=float, required=False, default=1.0, help='Exponent of the post\'s age in days in (the denominator of) its score')
+  parser.add_argument('--min-refresh-interval', type=float, required=False, default=kSecsPerHour * 6, help='Seconds before a post can be refreshed again')
+  parser.add_argument('--max-refresh-age', type=float, required=False, default=kSecsPerDay * 30, help='Seconds after which posts are no longer refreshed')
+
+def policy_from_args(args):
+  if args.refresh_policy == 'once':
+    return OncePolicy()
+  return RefreshPolicy(
+    velocity_weight=args.velocity_weight,
+    staleness_weight=args.staleness_weight,
+    age_weight=args.age_weight,
+    max_age=args.max_refresh_age,
+    min_interval=args.min_refresh_interval,
+  )
@@ -9,6 +9,8 @@ from urllib.parse import unquote, urlparse, parse_qs
 import pystache
 import spot
 
+from .indexversions import current_version
+
 import cgi
 import time
 
@@ -167,7 +169,9 @@ def search(query_text, max_results=100):
     return result
 
   # index = spot.Index('reddit/spot-index-19-and-20')
-  index = spot.Index('reddit/spot-index')
+  # Resolved on every request, so a newly published version (see
+  # indexversions.py) is picked up without a restart.
+  index = spot.Index(current_version('reddit/spot-index'))
   start_time = time.time()
   print(f'search {query_text}')
 
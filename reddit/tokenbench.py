@@ -0,0 +1,99 @@
+"""
+Checks that html2tokens() gives the same tokens as the old two-pass
+tokenizer (MyHTMLParser, then a regex and several replace() passes), and
+measures how much faster it and the token cache are.
+
+python3 reddit/tokenbench.py
+python3 reddit/tokenbench.py --corpus reddit/c2 --threads 200
+"""
+
+import argparse, itertools, time
+
+from utils import *
+
+# The tokenizer html2tokens() replaced, kept to check against.
+def reference_text2tokens(text):
+  text = text.lower()
+  text = re.sub(r"[^\w\d%@#$^&']+", " ", text)
+  text = ' ' + text + ' '
+  text = text.replace(" '", " ")
+  text = text.replace("' ", " ")
+  tokens = set(text.strip().split(' '))
+  if '' in tokens:
+    tokens.remove('')
+  for token in kTokenBlacklist:
+    if token in tokens:
+      tokens.remove(token)
+  return tokens
+
+kReferenceParser = MyHTMLParser()
+
+def reference_html2tokens(html):
+  kReferenceParser.reset()
+  kReferenceParser.feed(html)
+  kReferenceParser.close()
+  return frozenset(reference_text2tokens(kReferenceParser.text)), frozenset(link_domains(kReferenceParser.links))
+
+# The sentences utils.py asserts on, plus some HTML that exercises quotes,
+# links, entities and unicode.
+kSamples = [
+  "'I've done things – foo bar!'",
+  "you're bar (and doesn't endorse).",
+  'When people say "Red tribe" "incorrectly", it\'s usually',
+  "because they're not particularly concerned with the distinction between Republican and Red. They're trying",
+]
+
+kHtmlSamples = [f'<div class="md"><p>{s}</p>\n</div>' for s in kSamples] + [
+  '<div class="md"><blockquote>\n<p>quoted \'\'text\'\' here</p>\n</blockquote>\n<p>and a <a href="https://www.example.com/x">link</a> to <a href="https://en.wikipedia.org/wiki/Foo">Foo</a></p>\n</div>',
+  '<div class="md"><p>https:\\/\\/www.example.com\\/raw-url and ca&#39;t &amp; won&#39;t, naïve café ÉCOLE _under_score 100% #tag @user $5 ^up</p>\n</div>',
+  '<div class="md"><p>\' lone \'\' quotes\' \'x\' y\'\'</p><ul><li>one</li><li>two<code>foo_bar()</code></li></ul></div>',
+  '<h2>A title</h2><div class="md"><p>self text with <strong>bold</strong>ly split<em>words</em></p></div>',
+  '<h2>Is a < b & c > d?</h2><div class="md"><p>x</p></div>',
+  '<DIV CLASS="md"><P>Upper <A HREF=\'http://www.foo.org/?a=1&amp;b=2\'>case</A> tags</P><!-- note --></DIV>',
+  '<div class="md"><p>unfinished <a href="https://x.com/"',
+]
+
+def time_it(fn, inputs, repeat):
+  start = time.time()
+  for _ in range(repeat):
+    for x in inputs:
+      fn(x)
+  return time.time() - start
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Check and benchmark the tokenizer')
+  parser.add_argument('--corpus', '-c', type=str, required=False, default=None, help='Corpus to take comments from (defaults to built-in samples)')
+  parser.add_argument('--threads', type=int, default=100, help='Threads to take from the corpus')
+  parser.add_argument('--repeat', '-r', type=int, default=None, help='Times to tokenize every input')
+  args = parser.parse_args()
+
+  for text in kSamples:
+    assert text2tokens(text) == reference_text2tokens(text), text
+
+  inputs = list(kHtmlSamples)
+  if args.corpus is not None:
+    for thread in itertools.islice(threads(base=args.corpus), args.threads):
+      inputs += [c['body_html'] for c in thread['comments'] if 'body_html' in c]
+  repeat = args.repeat if args.repeat is not None else max(1, 20000 // len(inputs))
+
+  mismatches = 0
+  for html in inputs:
+    if html2tokens(html) != reference_html2tokens(html):
+      mismatches += 1
+      print('MISMATCH', repr(html[:200]))
+      print('  new', sorted(html2tokens(html)[0]))
+      print('  old', sorted(reference_html2tokens(html)[0]))
+  print(f'{len(inputs)} inputs, {mismatches} mismatches')
+
+  n = len(inputs) * repeat
+  old = time_it(reference_html2tokens, inputs, repeat)
+  new = time_it(html2tokens, inputs, repeat)
+  cache = TokenCache()
+  time_it(cache.get, inputs, 1)
+  cached = time_it(cache.get, inputs, repeat)
+  print('%-20s %8.3fs %10.0f docs/s' % ('two-pass', old, n / old))
+  print('%-20s %8.3fs %10.0f docs/s %6.2fx' % ('single-pass', new, n / new, old / new))
+  print('%-20s %8.3fs %10.0f docs/s %6.2fx' % ('cached', cached, n / cached, old / cached))
+
+  if mismatches > 0:
+    exit(1)
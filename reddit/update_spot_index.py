@@ -0,0 +1,126 @@
+"""
+Applies the change journal (see journal.py) written by refresh.py and
+cronjob2.py to the spot index, so it stays fresh without re-running
+create_spot_index.py.  How far we've read is kept in <journal>.offset.
+create_spot_index.py also uses apply_journal() to bring a new version up to
+date before publishing it.
+
+python3 reddit/update_spot_index.py --corpus reddit/c2
+"""
+
+import argparse, os, time
+
+import spot
+
+from corpus import open_corpus
+from indexversions import current_version, lock_index
+from journal import ChangeJournal
+from utils import *
+
+def read_offset(path):
+  if not os.path.exists(path):
+    return 0
+  with open(path, 'r') as f:
+    return int(f.read().strip() or 0)
+
+def write_offset(path, offset):
+  with open(path + '.tmp', 'w') as f:
+    f.write(str(offset))
+  os.replace(path + '.tmp', path)
+
+# Removes a document from the index.  spot.Index has no delete(), so the
+# document's tokens are dropped with replace() and its row is then deleted
+# from the documents table through index.c (as IndexRefreshes does).
+# Returns whether there was such a document; deleting one that's already
+# gone does nothing, so replaying the journal is idempotent.
+def delete_document(index, docid):
+  index.c.execute('SELECT postid, created_utc, json FROM documents WHERE docid = ?', (docid,))
+  row = index.c.fetchone()
+  if row is None:
+    return False
+  postid, created_utc, j = row
+  index.replace(docid, postid, created_utc, [], json.loads(j))
+  index.c.execute('DELETE FROM documents WHERE docid = ?', (docid,))
+  return True
+
+# Applies every change to one thread.  Returns the number of documents
+# replaced and deleted.
+def apply_changes(index, thread, changed, deleted):
+  tree = ThreadTree(thread)
+
+  # A new reply also changes its ancestors' replies: and subtree: tokens.
+  for cid in list(changed):
+    while cid in tree and tree.parent[cid] is not None:
+      cid = tree.parent[cid]
+      changed.add(cid)
+
+  replaced = 0
+  for cid in changed:
+    if cid not in tree:
+      deleted.add(cid)
+      continue
+    doc = prepare_document(dict(tree.comments[cid]), tree, thread)
+    if doc is None:
+      # The comment has been deleted since it was indexed.
+      deleted.add(cid)
+      continue
+    index.replace(doc['docid'], doc['postid'], doc['created_utc'], doc['tokens'], doc)
+    replaced += 1
+
+  removed = 0
+  for cid in deleted:
+    removed += delete_document(index, int(cid, 36))
+
+  return replaced, removed
+
+# Applies the journal from byte 'offset' on and commits.  Returns the
+# number of entries, documents replaced and documents deleted, and the
+# offset we read up to.
+def apply_journal(index, corpus, journal, offset, batch_size=1000):
+  # Collect changes per post first, so each thread is loaded once.
+  changes = {}
+  numEntries = 0
+  for entry, offset in journal.read(offset):
+    numEntries += 1
+    key = entry['postid']
+    if key not in changes:
+      changes[key] = (entry['year'], set(), set())
+    year, changed, deleted = changes[key]
+    changed.update(entry['inserted'])
+    changed.update(entry['updated'])
+    changed.difference_update(entry['deleted'])
+    deleted.update(entry['deleted'])
+
+  replaced, removed = 0, 0
+  for i, (postid, (year, changed, deleted)) in enumerate(changes.items()):
+    thread = corpus.get(postid, year)
+    if thread is None:
+      continue
+    r, d = apply_changes(index, thread, changed, deleted.difference(changed))
+    replaced += r
+    removed += d
+    if (i + 1) % batch_size == 0:
+      index.commit()
+
+  index.commit()
+  return numEntries, replaced, removed, offset
+
+def update_index(index, corpus, journal, offsetPath, batch_size=1000):
+  numEntries, replaced, removed, offset = apply_journal(index, corpus, journal, read_offset(offsetPath), batch_size)
+  # Only after the changes are committed do we mark them as read.
+  write_offset(offsetPath, offset)
+  return numEntries, replaced, removed
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Apply the change journal to the spot index')
+  parser.add_argument('--corpus', '-c', type=str, required=True, help='Corpus the journal refers to')
+  parser.add_argument('--journal', '-j', type=str, required=False, default=None, help='Change journal (defaults to journal.jsonl in the corpus)')
+  parser.add_argument('--indexpath', '-ip', type=str, required=False, default='reddit/spot-index', help='Location of spot index')
+  args = parser.parse_args()
+
+  startTime = time.time()
+  journalPath = pjoin(args.corpus, 'journal.jsonl') if args.journal is None else args.journal
+  with lock_index(args.indexpath):
+    index = spot.Index(current_version(args.indexpath))
+    entries, replaced, removed = update_index(index, open_corpus(args.corpus), ChangeJournal(journalPath), journalPath + '.offset')
+  print(f'Applied {entries} journal entries ({replaced} documents replaced, {removed} deleted) in %.1f seconds' % (time.time() - startTime))
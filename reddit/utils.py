@@ -1,5 +1,6 @@
-import argparse, array, hashlib, json, os, random, re, shutil, sqlite3
+import argparse, array, collections, concurrent.futures, hashlib, json, os, random, re, shutil, sqlite3, time
 from datetime import datetime
+from html import unescape
 from html.parser import HTMLParser
 from urllib.parse import urlparse
 pjoin = os.path.join
@@ -22,6 +23,20 @@ kSecsPerWeek = kSecsPerDay * 7
 kTokenBlacklist = set(["a", "the", "to", "of", "and", "that", "is"])
 
 kUrlRegex = r"https?:\\/\\/(www\\.)?[-a-zA-Z0-9@:%._\\+~#=]{1,256}\\.[a-zA-Z0-9()]{1,6}\\b([-a-zA-Z0-9()@:%_\\+.~#?&//=]*)"
+kUrlPattern = re.compile(kUrlRegex)
+
+# A token is a run of these characters (see text2tokens).
+kTokenPattern = re.compile(r"[\w\d%@#$^&']+")
+
+# Tags, and the href of an <a> tag, for html2tokens's fast path.
+kTagPattern = re.compile(r'<(/?)([a-zA-Z][^\t\n\r\f />\x00]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+kHrefPattern = re.compile(r'''(?:^|\s)href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
+
+# Number of comments' tokens kept by the token cache.
+kTokenCacheSize = 100000
+# Persisted token cache entries unused for this long are dropped (posts
+# aren't refreshed after a month anyway; see scheduler.py).
+kTokenCacheMaxAge = kSecsPerDay * 31
 
 class MyHTMLParser(HTMLParser):
   def __init__(self, ignore_quotes=True):
@@ -63,23 +78,260 @@ def permalink2postid(permalink):
   assert parts[3] == 'comments'
   return int(parts[4], 36)
 
-def threads(years=None, base='reddit/c2'):
-  # base = 'reddit/comments'
+# The inverse of int(s, 36), e.g. for turning a docid back into an id.
+def base36(n):
+  digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+  s = ''
+  while n > 0:
+    n, r = divmod(n, 36)
+    s = digits[r] + s
+  return s or '0'
+
+def thread_files(years=None, base='reddit/c2'):
   if years is None:
     years = os.listdir(base)
-  years.sort()
-  for year in years:
+  R = []
+  for year in sorted(years):
     if not year.isdigit():
       continue
     for fn in os.listdir(pjoin(base, year)):
       if fn[-5:] != '.json':
         continue
-      path = pjoin(base, year, fn)
-      with open(pjoin(base, year, fn), 'r') as f:
-        J = json.load(f)
-      yield J
+      R.append(pjoin(base, year, fn))
+  return R
+
+def load_thread(path):
+  with open(path, 'r') as f:
+    return json.load(f)
+
+def threads(years=None, base='reddit/c2'):
+  # base = 'reddit/comments'
+  # 'base' may also be a packed corpus (see corpus.py).  We import it here
+  # so that this module stays importable from the Django app.
+  if os.path.exists(pjoin(base, 'index.db')):
+    from corpus import SegmentStore
+    yield from SegmentStore(base).threads(years)
+    return
+  for path in thread_files(years, base):
+    yield load_thread(path)
+
+def _load_chunk(fn, chunk):
+  return [fn(*args) for args in chunk]
+
+# Returns the tasks that load every thread (see _load_chunk), as a
+# function and a list of (postid, signature, arguments).  A thread's
+# signature changes whenever it is rewritten: it's the file's mtime and size,
+# or the record's location in a packed corpus.
+def _thread_tasks(years, base):
+  if os.path.exists(pjoin(base, 'index.db')):
+    from corpus import SegmentStore, read_record
+    store = SegmentStore(base)
+    postids = [postid for _, postid in store.postids(years)]
+    locations = store.locations(years)
+    store.close()
+    return read_record, [(postid, '%s:%d:%d' % loc, loc) for postid, loc in zip(postids, locations)]
+  tasks = []
+  for path in thread_files(years, base):
+    st = os.stat(path)
+    tasks.append((os.path.basename(path)[:-5], f'{st.st_mtime_ns}:{st.st_size}', (path,)))
+  return load_thread, tasks
+
+# Runs worker(*args, chunk) for every 'chunksize' tasks on a pool of
+# 'processes' processes, yielding the results.  At most 'max_pending'
+# chunks are in flight.
+def _parallel_chunks(worker, args, tasks, processes=None, ordered=True, chunksize=16, max_pending=None):
+  chunks = iter([tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)])
+
+  if processes is None:
+    processes = os.cpu_count()
+  if max_pending is None:
+    max_pending = 2 * processes
+
+  executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+  try:
+    pending = collections.deque()
+    def submit():
+      chunk = next(chunks, None)
+      if chunk is not None:
+        pending.append(executor.submit(worker, *args, chunk))
+    for _ in range(max_pending):
+      submit()
+    while len(pending) > 0:
+      if ordered:
+        future = pending.popleft()
+      else:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        future = done.pop()
+        pending.remove(future)
+      submit()
+      yield future.result()
+  finally:
+    executor.shutdown(cancel_futures=True)
+
+"""
+Like threads(), but threads are decoded by a pool of 'processes' worker
+processes, 'chunksize' threads per task.  At most 'max_pending' tasks are
+in flight, so a slow consumer doesn't cause the whole corpus to be loaded
+into memory.  If 'ordered' is False threads are yielded as soon as they're
+decoded, rather than in the order threads() would yield them.
+"""
+def parallel_threads(years=None, base='reddit/c2', processes=None, ordered=True, chunksize=16, max_pending=None):
+  fn, tasks = _thread_tasks(years, base)
+  tasks = [args for _, _, args in tasks]
+  for R in _parallel_chunks(_load_chunk, (fn,), tasks, processes, ordered, chunksize, max_pending):
+    yield from R
+
+def _prepare_chunk(fn, subreddits, chunk):
+  startTime = time.time()
+  R = []
+  for postid, sig, args in chunk:
+    thread = fn(*args)
+    if subreddits is not None and thread['subreddit'] not in subreddits:
+      R.append((postid, sig, []))
+    else:
+      R.append((postid, sig, prepare_thread(thread)))
+  return R, time.time() - startTime
 
-parser = MyHTMLParser()
+"""
+Like parallel_threads(), but the workers also turn the threads into
+documents for the spot index (see prepare_thread()), so the caller only has
+to insert them.  Threads not from 'subreddits' (if given) get no documents,
+and threads for which 'skip(postid, signature)' is true aren't read at all.
+
+Yields ([(postid, signature, documents)], seconds the worker took) per
+chunk, in corpus order.
+"""
+def parallel_documents(years=None, base='reddit/c2', subreddits=None, processes=None, chunksize=16, max_pending=None, skip=None):
+  fn, tasks = _thread_tasks(years, base)
+  if skip is not None:
+    tasks = [t for t in tasks if not skip(t[0], t[1])]
+  yield from _parallel_chunks(_prepare_chunk, (fn, subreddits), tasks, processes, True, chunksize, max_pending)
+
+# Collects just what get_tokens needs from a comment's HTML: the text of
+# every data chunk that isn't a bare URL (like MyHTMLParser.text with
+# ignore_quotes), as a list of chunks, and the links.
+class TextExtractor(HTMLParser):
+  def reset(self):
+    super().reset()
+    self.chunks = []
+    self.links = set()
+  def handle_starttag(self, tag, attrs):
+    if tag != 'a':
+      return
+    for attr in attrs:
+      if attr[0] == 'href':
+        if len(attr) >= 2:
+          self.links.add(attr[1])
+        return
+  def handle_data(self, data):
+    if not kUrlPattern.match(data):
+      self.chunks.append(data)
+
+extractor = TextExtractor()
+
+def link_domains(links):
+  domains = set()
+  for link in links:
+    loc = urlparse(link).netloc
+    if loc[:4] == 'www.':
+      loc = loc[4:]
+    elif loc[:3] == 'en.':
+      loc = loc[3:]
+    domains.add(loc)
+  return domains
+
+# Does what TextExtractor does with one regex scan, for the HTML reddit
+# generates.  Returns None for anything that HTMLParser might treat
+# differently (comments, declarations, script/style contents or a '<' that
+# doesn't start a tag).
+def _extract_fast(html):
+  if '<!' in html or '<?' in html:
+    return None
+  chunks, links = [], set()
+  pos, numTags = 0, 0
+  for m in kTagPattern.finditer(html):
+    numTags += 1
+    if m.start() > pos:
+      chunks.append(html[pos:m.start()])
+    pos = m.end()
+    tag = m.group(2).lower()
+    if tag in ('script', 'style'):
+      return None
+    if tag == 'a' and not m.group(1):
+      href = kHrefPattern.search(m.group(3))
+      if href:
+        links.add(unescape(next(g for g in href.groups() if g is not None)))
+  if numTags != html.count('<'):
+    return None
+  if pos < len(html):
+    chunks.append(html[pos:])
+  chunks = [unescape(chunk) for chunk in chunks]
+  return [chunk for chunk in chunks if not kUrlPattern.match(chunk)], links
+
+# Returns (text tokens, linked domains) for a piece of HTML.
+def html2tokens(html):
+  r = _extract_fast(html)
+  if r is None:
+    extractor.reset()
+    extractor.feed(html)
+    extractor.close()
+    r = extractor.chunks, extractor.links
+  chunks, links = r
+  return frozenset(text2tokens(''.join(chunks))), frozenset(link_domains(links))
+
+# Remembers html2tokens() for the last 'capacity' pieces of HTML, keyed by
+# their hash, so comments that are re-indexed without having been edited
+# (e.g. by cronjob.py's refreshes) aren't parsed again.  persist() also
+# keeps entries in a sqlite file, for processes that start fresh every run.
+class TokenCache:
+  def __init__(self, capacity=kTokenCacheSize):
+    self.capacity = capacity
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.conn = None
+
+  # Entries are kept until they haven't been used for 'max_age' seconds.
+  def persist(self, path, max_age=kTokenCacheMaxAge):
+    self.conn = sqlite3.connect(path)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, used REAL, words TEXT, domains TEXT)')
+    self.conn.execute('DELETE FROM tokens WHERE used < ?', (time.time() - max_age,))
+    self.conn.commit()
+
+  def _load(self, key):
+    row = self.conn.execute('SELECT used, words, domains FROM tokens WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      return None
+    used, words, domains = row
+    # Only touch 'used' once a day, so hits are (almost always) reads.
+    if time.time() - used > kSecsPerDay:
+      self.conn.execute('UPDATE tokens SET used = ? WHERE key = ?', (time.time(), key))
+    return frozenset(json.loads(words)), frozenset(json.loads(domains))
+
+  def get(self, html):
+    key = hashlib.sha1(html.encode()).digest()
+    if key in self.entries:
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return self.entries[key]
+    value = None if self.conn is None else self._load(key)
+    if value is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      value = html2tokens(html)
+      if self.conn is not None:
+        self.conn.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)', (key, time.time(), json.dumps(sorted(value[0])), json.dumps(sorted(value[1]))))
+    self.entries[key] = value
+    if len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+    return value
+
+  def commit(self):
+    if self.conn is not None:
+      self.conn.commit()
+
+tokenCache = TokenCache()
 
 def getscore(comment):
   return comment.get('score', 0)
@@ -88,35 +340,37 @@ def getscore(comment):
 TODO: "i.e." should become "i.e."
 """
 def text2tokens(text):
-  text = text.lower()
-  text = re.sub(r"[^\w\d%@#$^&']+", " ", text)
-  text = ' ' + text + ' '
-  text = text.replace(" '", " ")
-  text = text.replace("' ", " ")
-  tokens = set(text.strip().split(' '))
-  if '' in tokens:
-    tokens.remove('')
-  for token in kTokenBlacklist:
-    if token in tokens:
-      tokens.remove(token)
+  # Equivalent to lower-casing, replacing every run of other characters with
+  # a space, splitting on spaces and then dropping one leading and one
+  # trailing quote from each token, but in one regex pass (and the quotes
+  # are only looked at once per distinct token).
+  tokens = set(kTokenPattern.findall(text.lower()))
+  quoted = [t for t in tokens if t[0] == "'" or t[-1] == "'"]
+  tokens.difference_update(quoted)
+  for token in quoted:
+    if token[0] == "'":
+      token = token[1:]
+    if token[-1:] == "'":
+      token = token[:-1]
+    if token:
+      tokens.add(token)
+  tokens.difference_update(kTokenBlacklist)
   return tokens
 
 def get_tokens(comment, parent, thread, isthread):
-  parser.reset()
+  html = ''
   if isthread:
     if ('selftext_html' in comment) and (comment['selftext_html'] != None):
-      parser.feed(f'<h2>{comment["title"]}</h2>' + comment['selftext_html'])
+      html = f'<h2>{comment["title"]}</h2>' + comment['selftext_html']
   else:
-    parser.feed(comment['body_html'])
-  parser.close()
+    html = comment['body_html']
+  words, domains = tokenCache.get(html)
 
-  links = parser.links
-  alltext = parser.alltext
   if thread:
     iscw = ('culture_war_roundup' in thread['url'])
 
   # Add comment's words to tokens.
-  tokens = text2tokens(parser.text)
+  tokens = set(words)
   assert '"' not in ' '.join(tokens)
 
   # Add author to tokens
@@ -146,14 +400,6 @@ def get_tokens(comment, parent, thread, isthread):
       s = 'TheMotte'
     tokens.add(f'sub:{s.lower()}')
 
-  domains = set()
-  for link in parser.links:
-    loc = urlparse(link).netloc
-    if loc[:4] == 'www.':
-      loc = loc[4:]
-    elif loc[:3] == 'en.':
-      loc = loc[3:]
-    domains.add(loc)
   for domain in domains:
     tokens.add(f'linksto:{domain}')
   
@@ -169,6 +415,110 @@ def get_tokens(comment, parent, thread, isthread):
 
   return tokens
 
+# The shape of a thread's comment tree, computed in one pass over its
+# comments:
+#
+#   comments[id]     the comment
+#   parent[id]       id of the comment it replies to, or None for top-level
+#                    comments (and comments whose parent we don't have)
+#   children[id]     ids of its replies, in thread order
+#   depth[id]        1 for top-level comments, 2 for their replies, ...
+#   root[id]         id of its top-level ancestor (itself if top-level)
+#   descendants[id]  number of comments below it
+class ThreadTree:
+  def __init__(self, thread):
+    self.comments = {}
+    for comment in thread['comments']:
+      self.comments[comment['id']] = comment
+
+    self.parent = {}
+    self.children = {}
+    roots = []
+    for cid, comment in self.comments.items():
+      self.children[cid] = []
+    for cid, comment in self.comments.items():
+      pid = comment['parent_id'][3:]
+      if pid in self.comments and pid != cid:
+        self.parent[cid] = pid
+        self.children[pid].append(cid)
+      else:
+        self.parent[cid] = None
+        roots.append(cid)
+
+    # Depth and root on the way down, descendants on the way back up.
+    self.depth, self.root, self.descendants = {}, {}, {}
+    for rootid in roots:
+      self.depth[rootid] = 1
+      self.root[rootid] = rootid
+      stack = [(rootid, False)]
+      while len(stack) > 0:
+        cid, done = stack.pop()
+        if done:
+          self.descendants[cid] = sum(self.descendants[c] + 1 for c in self.children[cid])
+          continue
+        stack.append((cid, True))
+        for child in self.children[cid]:
+          self.depth[child] = self.depth[cid] + 1
+          self.root[child] = rootid
+          stack.append((child, False))
+
+  def __contains__(self, cid):
+    return cid in self.comments
+
+  # The parent comment, or None.
+  def parent_comment(self, cid):
+    pid = self.parent[cid]
+    return None if pid is None else self.comments[pid]
+
+  def replies(self, cid):
+    return len(self.children[cid])
+
+  # Filter tokens describing the comment's place in the tree.
+  def tokens(self, cid):
+    return [f'replies:{self.replies(cid)}', f'subtree:{self.descendants[cid]}']
+
+# Turns a comment from 'thread' into a document for the spot index, or
+# returns None if it shouldn't be indexed (e.g. it was deleted).  'tree' is
+# the thread's ThreadTree.
+def prepare_document(comment, tree, thread):
+  if 'body_html' not in comment:
+    return None
+  if comment.get('body', '') == '[deleted]':
+    return None
+  if comment['body_html'] == '<div class="md"><p>[deleted]</p>\n</div>':
+    return None
+
+  # Threads have depth = 0
+  # All comments have depth > 0
+  comment['depth'] = tree.depth[comment['id']]
+  parent = tree.parent_comment(comment['id'])
+
+  tokens = get_tokens(comment, parent, thread, isthread=False)
+  tokens.update(tree.tokens(comment['id']))
+
+  # Save some space -- all this information is in body_html anyway
+  if 'body' in comment:
+    del comment['body']
+
+  if 'score' not in comment:
+    comment['score'] = comment.get('ups', 0)
+
+  comment['random'] = random.random()
+  comment['docid'] = int(comment['id'], 36)
+  comment['postid'] = permalink2postid(comment['permalink'])
+  comment['tokens'] = list(tokens)
+  return comment
+
+# Returns the documents for every comment in 'thread' that should be indexed.
+def prepare_thread(thread):
+  tree = ThreadTree(thread)
+  R = []
+  for comment in thread['comments']:
+    doc = prepare_document(comment, tree, thread)
+    if doc is not None:
+      R.append(doc)
+  return R
+
 assert text2tokens("'I've done things – foo bar!'") == set([
   "i've", "done", "foo", "bar", "things"
 ])